@@ -0,0 +1,346 @@
+"""
+Search latency benchmark over a synthetic site.
+
+    python benchmark.py --pages 10000 --requests 2000 --output bench.json
+    python benchmark.py --mode http --workers 2 --pages 1000
+
+Pages are generated from a seeded random vocabulary with Zipf-distributed
+word frequencies, spread over a few section directories. The query mix
+replays live keystrokes, full searches, phrase searches, filtered searches
+and searches with a custom template. In "inprocess" mode search() is awaited
+directly; in "http" mode a uvicorn server is started over the corpus (or
+--url is used) and queried through /api/search.
+
+The report is JSON: p50/p95/p99 latency in milliseconds overall and per
+query kind, throughput, index build time and peak RSS. The corpus and the
+queries depend only on the parameters and --seed, so reports of different
+commits run with the same parameters are comparable.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from search_cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ("docs", "blog", "news", "shop")
+SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "pra", "dex", "lin", "tor", "gen", "bel", "qui", "zor")
+CUSTOM_TEMPLATE = "<li><a href='#{href}'>#{title}</a> #{description} (#{count})</li>"
+
+# Share of each query kind in the mix
+QUERY_MIX = (("live", 0.4), ("full", 0.25), ("phrase", 0.1), ("filter", 0.15), ("template", 0.1))
+
+# (kind, s, filter, template, liveCount, liveSearch)
+Request = Tuple[str, str, str, Optional[str], Optional[int], Optional[str]]
+
+
+def make_vocabulary(size: int, rng: random.Random) -> List[str]:
+    """size distinct pronounceable words; their order is their frequency rank"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def generate_corpus(directory: str, pages: int, words_per_page: int, vocabulary: List[str], seed: int) -> List[str]:
+    """Write pages HTML files under directory and return their paths"""
+    rng = random.Random(seed)
+    cum_weights = []
+    total = 0.0
+    for rank in range(len(vocabulary)):
+        total += 1.0 / (rank + 1)
+        cum_weights.append(total)
+
+    paths = []
+    for i in range(pages):
+        section = Path(directory) / SECTIONS[i % len(SECTIONS)]
+        section.mkdir(parents=True, exist_ok=True)
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=words_per_page)
+        title = ' '.join(words[:3]).capitalize()
+        description = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=8))
+        paragraphs = ''.join(f"<p>{' '.join(words[start:start + 40])}.</p>"
+                             for start in range(3, len(words), 40))
+        path = section / f"page{i}.html"
+        path.write_text(f"<html><head><title>{title}</title><meta name='description' content='{description}'>"
+                        f"</head><body><h1>{title}</h1>{paragraphs}</body></html>", encoding='utf-8')
+        paths.append(str(path))
+    return paths
+
+
+def make_requests(count: int, vocabulary: List[str], seed: int) -> List[Request]:
+    """A reproducible mix of search requests over the most frequent words"""
+    rng = random.Random(seed + 1)
+    # Queries mostly use common words, like real visitors do
+    common = vocabulary[:max(len(vocabulary) // 10, 10)]
+    kinds = [kind for kind, _ in QUERY_MIX]
+    weights = [weight for _, weight in QUERY_MIX]
+    requests = []
+    while len(requests) < count:
+        kind = rng.choices(kinds, weights)[0]
+        word = rng.choice(common)
+        if kind == "live":
+            # Every keystroke of a word from the third letter on
+            for end in range(3, len(word) + 1):
+                requests.append((kind, word[:end], "*", None, 5, "true"))
+        elif kind == "full":
+            requests.append((kind, f"{word} {rng.choice(common)}", "*", None, None, None))
+        elif kind == "phrase":
+            requests.append((kind, f'"{word} {rng.choice(common)}"', "*", None, None, None))
+        elif kind == "filter":
+            requests.append((kind, word, f"{rng.choice(SECTIONS)}/*.html", None, None, None))
+        else:
+            requests.append((kind, word, "*", CUSTOM_TEMPLATE, None, None))
+    return requests[:count]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds"""
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "requests": len(values),
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+        "max_ms": round(values[-1], 3) if values else 0.0,
+    }
+
+
+async def drive(requests: List[Request], concurrency: int, send) -> Tuple[Dict[str, List[float]], float]:
+    """
+    Send requests from concurrency concurrent clients; return the latencies
+    by query kind and the wall time
+    """
+    latencies: Dict[str, List[float]] = {}
+    queue = iter(requests)
+
+    async def client():
+        for request in queue:
+            started = time.perf_counter()
+            await send(request)
+            latencies.setdefault(request[0], []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+def peak_rss_kb(pid: Optional[int] = None) -> Optional[int]:
+    """Peak resident set size of this process or of pid, in KiB"""
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KiB elsewhere
+        return usage // 1024 if sys.platform == "darwin" else usage
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Uncoalesced(SingleFlight):
+    """SingleFlight that coalesces nothing: every request computes its own response"""
+
+    async def run(self, key, func):
+        self.requests += 1
+        return await func()
+
+
+@contextmanager
+def serving(corpus: str, cache_dir: str, cache: bool) -> Iterator:
+    """
+    Point the search module at corpus for the duration of an in-process run;
+    without cache, responses are neither cached nor shared by identical
+    concurrent requests
+    """
+    import search
+    from config import settings
+    saved = (settings.search_dir, settings.search_dirs, settings.cache_dir, search.index_refresher,
+             search.result_cache, search.compressed_cache, search.search_flights)
+    try:
+        settings.search_dir = corpus
+        settings.search_dirs = []
+        settings.cache_dir = cache_dir
+        search.index_refresher = search.create_refresher()
+        if not cache:
+            search.result_cache = None
+            search.compressed_cache = None
+            search.search_flights = Uncoalesced()
+        yield search
+    finally:
+        (settings.search_dir, settings.search_dirs, settings.cache_dir, search.index_refresher,
+         search.result_cache, search.compressed_cache, search.search_flights) = saved
+
+
+async def run_inprocess(corpus: str, cache_dir: str, requests: List[Request], concurrency: int,
+                        cache: bool) -> dict:
+    with serving(corpus, cache_dir, cache) as search:
+        started = time.perf_counter()
+        await search.run_in_search_pool(search.get_index)
+        build_seconds = time.perf_counter() - started
+
+        async def send(request: Request):
+            _, s, filter_pattern, template, live_count, live_search = request
+            await search.search(s, filter_pattern, template or search.DEFAULT_TEMPLATE, live_count, live_search,
+                                False, None, None, None, None, None)
+
+        latencies, wall = await drive(requests, concurrency, send)
+    return {"build_seconds": round(build_seconds, 3), "latencies": latencies, "wall_seconds": wall,
+            "peak_rss_kb": peak_rss_kb()}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(client, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.get(url + "/")
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"server at {url} did not start within {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+async def run_http(corpus: str, cache_dir: str, requests: List[Request], concurrency: int, cache: bool,
+                   workers: int, url: Optional[str]) -> dict:
+    import httpx
+
+    server = None
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, SEARCH_DIR=corpus, SEARCH_DIRS="[]", CACHE_DIR=cache_dir, CACHE_ENABLED=str(cache).lower(),
+                   SEARCH_WATCH_FILES="false")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(workers), "--log-level", "warning"],
+            cwd=str(Path(__file__).parent), env=env
+        )
+    try:
+        async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency)) as client:
+            await wait_for_server(client, url)
+            # The first search builds the index
+            started = time.perf_counter()
+            (await client.get(url + "/api/search", params={"s": requests[0][1]})).raise_for_status()
+            build_seconds = time.perf_counter() - started
+
+            async def send(request: Request):
+                _, s, filter_pattern, template, live_count, live_search = request
+                params = {"s": s, "filter": filter_pattern}
+                if template:
+                    params["template"] = template
+                if live_search:
+                    params.update(liveSearch=live_search, liveCount=live_count)
+                (await client.get(url + "/api/search", params=params)).raise_for_status()
+
+            latencies, wall = await drive(requests, concurrency, send)
+        # With several workers this is the peak of the supervisor process only
+        rss = peak_rss_kb(server.pid) if server is not None and workers == 1 else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+    return {"build_seconds": round(build_seconds, 3), "latencies": latencies, "wall_seconds": wall,
+            "peak_rss_kb": rss}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=str(Path(__file__).parent)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(args: argparse.Namespace, run: dict) -> dict:
+    latencies = run["latencies"]
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "corpus_dir")},
+        "build_seconds": run["build_seconds"],
+        "throughput_rps": round(total / run["wall_seconds"], 1) if run["wall_seconds"] else None,
+        "peak_rss_kb": run["peak_rss_kb"],
+        "latency": summarize([latency for values in latencies.values() for latency in values]),
+        "by_kind": {kind: summarize(values) for kind, values in sorted(latencies.items())},
+    }
+
+
+def benchmark(args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = args.corpus_dir or str(Path(temp_dir) / "site")
+        vocabulary = make_vocabulary(args.vocabulary, random.Random(args.seed))
+        if not args.corpus_dir or not any(Path(corpus).rglob("*.html")):
+            started = time.perf_counter()
+            generate_corpus(corpus, args.pages, args.words, vocabulary, args.seed)
+            logger.info(f"Generated {args.pages} pages in {time.perf_counter() - started:.2f}s")
+        requests = make_requests(args.requests, vocabulary, args.seed)
+        cache_dir = str(Path(temp_dir) / "cache")
+        Path(cache_dir).mkdir()
+
+        if args.mode == "http":
+            run = asyncio.run(run_http(corpus, cache_dir, requests, args.concurrency, args.cache, args.workers,
+                                       args.url))
+        else:
+            run = asyncio.run(run_inprocess(corpus, cache_dir, requests, args.concurrency, args.cache))
+    return report(args, run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark site search over a synthetic corpus")
+    parser.add_argument("--mode", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--pages", type=int, default=1000, help="Pages in the corpus")
+    parser.add_argument("--words", type=int, default=300, help="Words per page")
+    parser.add_argument("--vocabulary", type=int, default=5000, help="Distinct words in the corpus")
+    parser.add_argument("--requests", type=int, default=1000, help="Search requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the corpus and the query mix")
+    parser.add_argument("--cache", action="store_true", help="Keep the search result cache enabled")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers in http mode")
+    parser.add_argument("--url", help="Benchmark a running server instead of starting one (http mode)")
+    parser.add_argument("--corpus-dir", help="Keep the corpus here and reuse it across runs")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(result + "\n")
+    else:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Prebuild the site search index wherever the site is deployed:
+
+    python build_index.py --workers 4
+
+The server memory-maps the written snapshot at startup and only re-indexes
+pages that changed after it was built. With several SEARCH_DIRS every root
+gets a snapshot of its own.
+
+The Docker image does not run it: the image holds the application, not
+the site, and the default SEARCH_DIR ("..") would be the image's root
+directory there.
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+from config import settings
+from search import INDEX_FILE, list_files, search_roots, shard_file
+from search_index import build_index_parallel
+from search_snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the site search index")
+    parser.add_argument("--search-dir", help="Directory with the site pages, default: the configured roots")
+    parser.add_argument("--workers", type=int, default=settings.search_index_workers,
+                        help="Worker processes, 0 = one per CPU core")
+    parser.add_argument("--output", help="Where to write the index snapshot (with --search-dir)")
+    args = parser.parse_args()
+
+    if args.search_dir:
+        targets = [(args.search_dir, args.output or str(Path(settings.cache_dir) / INDEX_FILE))]
+    else:
+        targets = [(root, shard_file(INDEX_FILE, number)) for number, root in enumerate(search_roots())]
+
+    for search_dir, output in targets:
+        started = time.perf_counter()
+        files = list_files(search_dir, settings.search_extensions)
+        index = build_index_parallel(files, args.workers)
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        write_snapshot(index, output)
+        logger.info(f"Indexed {len(index)} of {len(files)} files ({len(index.terms)} terms) "
+                    f"in {time.perf_counter() - started:.2f}s, written to {output}")
+
+
+if __name__ == "__main__":
+    main()
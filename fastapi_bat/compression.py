@@ -0,0 +1,180 @@
+"""
+Compressed responses.
+
+Static assets are compressed once, ahead of time: precompress() writes a
+.br and a .gz sibling next to every compressible file of the site, and
+PrecompressedStaticFiles serves the best sibling the client accepts,
+falling back to the file itself. A sibling older than its file is ignored
+until it is rebuilt. Dynamic responses are compressed on the fly by
+compress() at a lower, faster level.
+"""
+import gzip
+import mimetypes
+import os
+import stat
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+# brotli is optional: without it only gzip is produced and served
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content-Encoding and file suffix of every encoding served, preferred first
+VARIANTS: List[Tuple[str, str]] = [("br", ".br"), ("gzip", ".gz")]
+
+# Encodings this process can compress with
+ENCODINGS = [(encoding, suffix) for encoding, suffix in VARIANTS if encoding != "br" or brotli is not None]
+
+COMPRESSIBLE_EXTENSIONS = {
+    "html", "htm", "css", "js", "mjs", "json", "map", "xml", "svg", "txt", "ico", "ttf", "otf", "eot"
+}
+
+# Levels for files compressed once at build time and for responses compressed per request
+STATIC_LEVELS = {"br": 11, "gzip": 9}
+DYNAMIC_LEVELS = {"br": 4, "gzip": 6}
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    """data compressed with encoding ("br" or "gzip"), by default at the dynamic level"""
+    level = DYNAMIC_LEVELS[encoding] if level is None else level
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Quality value of every coding listed in an Accept-Encoding header"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def choose_encoding(accept_encoding: Optional[str], available: List[str]) -> Optional[str]:
+    """
+    The encoding of available (in order of preference) with the highest
+    quality in accept_encoding, or None to send the response as it is
+    """
+    if not accept_encoding:
+        return None
+    accepted = accepted_encodings(accept_encoding)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(path: str) -> bool:
+    return Path(path).suffix.lstrip('.').lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def precompress_file(path: str, min_size: int) -> int:
+    """
+    Write the missing or outdated compressed siblings of path and return
+    how many were written. A sibling is only kept when it is smaller than
+    the file; files under min_size bytes get none.
+    """
+    source = os.stat(path)
+    written = 0
+    data = None
+    for encoding, suffix in ENCODINGS:
+        target = path + suffix
+        try:
+            current = os.stat(target)
+            if current.st_mtime_ns >= source.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            current = None
+        if data is None:
+            data = Path(path).read_bytes()
+        compressed = compress(data, encoding, STATIC_LEVELS[encoding]) if len(data) >= min_size else None
+        if compressed is None or len(compressed) >= len(data):
+            if current is not None:
+                os.remove(target)
+            continue
+        temp = f"{target}.{os.getpid()}.tmp"
+        Path(temp).write_bytes(compressed)
+        os.replace(temp, target)
+        written += 1
+    return written
+
+
+def precompress(directory: str, min_size: int) -> Dict[str, int]:
+    """Precompress every compressible file under directory, skipping hidden directories"""
+    files = written = 0
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in names:
+            path = os.path.join(root, name)
+            if is_compressible(path):
+                files += 1
+                written += precompress_file(path, min_size)
+    return {"files": files, "written": written}
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles serving the precompressed sibling of a file when the client
+    accepts its encoding. Responses for compressible files vary by
+    Accept-Encoding; every variant has its own ETag, taken from the stat of
+    the file actually sent.
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        if not is_compressible(str(full_path)):
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        request_headers = Headers(scope=scope)
+        variant = self.find_variant(str(full_path), stat_result, request_headers.get("accept-encoding"))
+        if variant is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers["vary"] = "Accept-Encoding"
+            return response
+
+        encoding, path, variant_stat = variant
+        response = FileResponse(
+            path, status_code=status_code, stat_result=variant_stat, method=scope["method"],
+            media_type=mimetypes.guess_type(str(full_path))[0] or "text/plain",
+            headers={"content-encoding": encoding, "vary": "Accept-Encoding"}
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def find_variant(self, full_path: str, stat_result: os.stat_result,
+                     accept_encoding: Optional[str]) -> Optional[Tuple[str, str, os.stat_result]]:
+        """(encoding, path, stat) of the best up-to-date sibling the client accepts"""
+        if not accept_encoding:
+            return None
+        available = []
+        for encoding, suffix in VARIANTS:
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(variant_stat.st_mode) and variant_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+                available.append((encoding, full_path + suffix, variant_stat))
+        encoding = choose_encoding(accept_encoding, [encoding for encoding, _, _ in available])
+        return next((variant for variant in available if variant[0] == encoding), None)
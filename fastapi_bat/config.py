@@ -24,15 +24,30 @@ class Settings(BaseSettings):
     cache_enabled: bool = True
     cache_lifetime: int = 3600  # in seconds
     cache_dir: str = "cache"
+    search_document_cache_size: int = 64 * 1024 * 1024  # in bytes, parsed pages kept in memory
+    search_result_cache_size: int = 16 * 1024 * 1024  # in bytes, serialized search responses
+    search_result_cache_disk: bool = True  # Also keep search responses in cache_dir
+    search_result_cache_disk_size: int = 64 * 1024 * 1024  # in bytes, oldest cache files are removed beyond it
+    search_cache_control: str = "public, no-cache"  # Cache-Control of search responses; they are revalidated by ETag
+    redis_url: Optional[str] = None  # e.g. redis://redis:6379, shares search responses and index generations across workers
     
     # Application Settings
     app_host: str = "0.0.0.0"
     app_port: int = 8000
     debug: bool = False
+    static_dir: str = ".."  # Site root served as static files
+    compress_min_size: int = 1024  # in bytes, smaller static files and search responses are sent uncompressed
     
     # Search Settings
     search_dir: str = ".."  # Relative to the web root
+    search_dirs: list = []  # Several site roots, each indexed as a shard; empty = [search_dir]
     search_extensions: list = ["html", "htm"]
+    search_watch_files: bool = True  # Use inotify (watchfiles) to pick up page edits
+    search_refresh_interval: int = 30  # in seconds, stat sweep period without a watcher
+    search_max_workers: int = 4  # Threads running search queries and index builds
+    search_index_workers: int = 0  # Processes for full index builds, 0 = one per CPU core
+    search_shared_index: bool = False  # With several workers: they map one index maintained by one of them
+    search_backend: str = "index"  # "index" (in-memory inverted index) or "sqlite" (FTS5 database in cache_dir)
     
     class Config:
         env_file = ".env"
@@ -1,6 +1,5 @@
 import logging
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Form
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from typing import Optional, Dict, Any
@@ -13,6 +12,7 @@ from pathlib import Path
 import asyncio
 from datetime import datetime
 from config import settings
+from compression import PrecompressedStaticFiles
 from search import router as search_router
 from recaptcha import router as recaptcha_router
 
@@ -338,8 +338,9 @@ async def handle_mailform(request: Request, background_tasks: BackgroundTasks):
         logger.error(f"Error processing form submission: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Mount static files (HTML, CSS, JS, images, etc.) from the parent directory
-app.mount("/", StaticFiles(directory="../", html=True), name="static")
+# Mount static files (HTML, CSS, JS, images, etc.) from STATIC_DIR (the parent directory),
+# serving the .br/.gz siblings written by precompress.py where accepted
+app.mount("/", PrecompressedStaticFiles(directory=settings.static_dir, html=True), name="static")
 
 
 @app.get("/api/")
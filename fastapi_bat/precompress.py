@@ -0,0 +1,41 @@
+"""
+Write compressed siblings of the static assets wherever the site is
+deployed, after every deploy:
+
+    python precompress.py --static-dir /path/to/site
+
+Every compressible file of the site (CSS, JS, HTML, SVG, ...) gets a .gz
+and, with the brotli package installed, a .br sibling, which the server
+sends to clients accepting that encoding instead of compressing the file
+on every request. Siblings still newer than their file are kept, so
+running it again only recompresses what changed.
+
+The Docker image does not run it: the image holds the application, not
+the site, and the default STATIC_DIR ("..") would be the image's root
+directory there.
+"""
+import argparse
+import logging
+import time
+from config import settings
+from compression import ENCODINGS, precompress
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompress the static assets of the site")
+    parser.add_argument("--static-dir", default=settings.static_dir, help="Site root, default: STATIC_DIR")
+    parser.add_argument("--min-size", type=int, default=settings.compress_min_size,
+                        help="Leave smaller files uncompressed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    result = precompress(args.static_dir, args.min_size)
+    logger.info(f"Checked {result['files']} files in {args.static_dir}, wrote {result['written']} "
+                f"{'/'.join(suffix for _, suffix in ENCODINGS)} files in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
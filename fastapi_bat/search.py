@@ -1,10 +1,23 @@
 import logging
-from fastapi import APIRouter, Query
-from typing import Optional
-import os
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import functools
+import json
 import re
 from pathlib import Path
 from config import settings
+from compression import ENCODINGS, choose_encoding, compress
+from search_cache import LRUCache, ResultCache, SharedCache, SingleFlight
+from search_backend import SearchHit, SearchView, as_view
+from search_index import TOKEN_RE, SearchIndex, SearchQuery, parse_query
+from search_refresh import IndexRefresher, SharedIndexRefresher
+from search_shards import ShardedRefresher
+from search_sqlite import SqliteRefresher
+from search_template import TemplatePlan, compile_template, template_cache
 
 # Налаштування логування
 logging.basicConfig(
@@ -16,7 +29,18 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 # Constants
-SIDE_CHARS = 15
+SUGGEST_LIMIT = 5
+# Typeahead ranks at most this many of the pages matching the completions
+SUGGEST_CANDIDATES = 100
+MAX_PAGE_SIZE = 100
+# Version of the response bodies; bump it whenever a change to the code
+# changes what a search returns, so that results cached (on disk, in
+# Redis) by an older version are not served
+RESPONSE_FORMAT = 2
+INDEX_FILE = "search_index.bin"
+DATABASE_FILE = "search.sqlite3"
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+DEFAULT_TEMPLATE = "<h5 class='search_title'><a target='_top' href='#{href}' class='search_link'>#{title}</a></h5><p>...#{token}...</p><p class='match'><em>Terms matched: #{count} - URL: #{href}</em></p>"
 
 def list_files(search_dir: Optional[str] = None, search_in: list = None) -> list:
     """Recursively list all files in a directory with specified extensions"""
@@ -35,6 +59,162 @@ def list_files(search_dir: Optional[str] = None, search_in: list = None) -> list
     
     return result
 
+# Parsed pages keyed by (path, mtime, size), reused across index rebuilds
+document_cache = (
+    LRUCache(settings.search_document_cache_size, sizeof=lambda document: document.size)
+    if settings.cache_enabled else None
+)
+
+# Index generation counter and search responses shared by all workers
+# through Redis; None without REDIS_URL
+shared_cache = SharedCache.from_url(settings.redis_url)
+
+# Serialized responses keyed by corpus fingerprint and normalized query
+result_cache = (
+    ResultCache(settings.cache_lifetime, settings.search_result_cache_size,
+                str(Path(settings.cache_dir) / "search") if settings.search_result_cache_disk else None,
+                shared_cache, settings.search_result_cache_disk_size)
+    if settings.cache_enabled else None
+)
+
+# Compressed search responses keyed by ETag and encoding
+compressed_cache = LRUCache(settings.search_result_cache_size) if settings.cache_enabled else None
+
+# Identical searches running at the same time share one computation
+search_flights = SingleFlight()
+
+def search_roots() -> list:
+    """Configured site roots, one index shard each"""
+    return settings.search_dirs or [settings.search_dir]
+
+def shard_file(name: str, number: int) -> str:
+    """Path in cache_dir of the index file of shard number, e.g. search_index.1.bin"""
+    if len(search_roots()) > 1:
+        name = f"{Path(name).stem}.{number}{Path(name).suffix}"
+    return str(Path(settings.cache_dir) / name)
+
+def create_refresher() -> Union[IndexRefresher, ShardedRefresher]:
+    """
+    Refresher of the configured search backend (in-memory index or SQLite
+    FTS5), one per site root when there are several
+    """
+    roots = search_roots()
+    refreshers = [create_shard_refresher(root, number) for number, root in enumerate(roots)]
+    if len(refreshers) == 1:
+        return refreshers[0]
+    return ShardedRefresher(roots, refreshers, shard_executor)
+
+def create_shard_refresher(root: str, number: int) -> IndexRefresher:
+    options = dict(
+        interval=settings.search_refresh_interval,
+        use_watcher=settings.search_watch_files,
+        document_cache=document_cache,
+        workers=settings.search_index_workers,
+        on_publish=(lambda index: shared_cache.bump()) if shared_cache is not None else None,
+    )
+    pages = lambda: list_files(root, settings.search_extensions)
+    if settings.search_backend == "sqlite":
+        Path(settings.cache_dir).mkdir(parents=True, exist_ok=True)
+        return SqliteRefresher(pages, root, settings.search_extensions, shard_file(DATABASE_FILE, number), **options)
+    # With several workers, one builds the index and the others map its snapshot
+    refresher_class = SharedIndexRefresher if settings.search_shared_index else IndexRefresher
+    return refresher_class(pages, root, settings.search_extensions,
+                           snapshot_path=shard_file(INDEX_FILE, number), **options)
+
+# File reads, parsing and query evaluation are blocking, so they run in a
+# bounded pool instead of on the event loop shared with the other endpoints
+search_executor = ThreadPoolExecutor(max_workers=settings.search_max_workers, thread_name_prefix="search")
+
+# Queries of the search pool fan out to the shards in a pool of their own,
+# so that they never wait for a free thread of the pool they occupy
+shard_executor = ThreadPoolExecutor(max_workers=settings.search_max_workers, thread_name_prefix="search-shard")
+
+# Search index shared by all requests, kept up to date in the background
+index_refresher = create_refresher()
+
+async def run_in_search_pool(func, *args):
+    """Run a blocking search function in the search thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_executor, functools.partial(func, *args))
+
+def get_index() -> Union[SearchIndex, SearchView]:
+    """
+    Return the current generation of the site search index: a SearchIndex,
+    or the view of another backend. When another worker announced a new
+    generation, the files are checked for changes first.
+    """
+    if shared_cache is not None and shared_cache.poll():
+        return index_refresher.refresh()
+    return index_refresher.get_index()
+
+@router.on_event("startup")
+async def start_index_refresher():
+    index_refresher.start()
+
+@router.on_event("shutdown")
+async def stop_index_refresher():
+    index_refresher.stop()
+    search_executor.shutdown(wait=False)
+    shard_executor.shutdown(wait=False)
+
+@router.get("/search/stats")
+async def search_stats():
+    """Index and cache statistics for monitoring"""
+    index = await run_in_search_pool(lambda: as_view(get_index()).describe())
+    return {
+        "index": index,
+        "document_cache": document_cache.stats() if document_cache is not None else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "compressed_cache": compressed_cache.stats() if compressed_cache is not None else None,
+        "template_cache": template_cache.stats(),
+        "search_flights": search_flights.stats(),
+    }
+
+@router.get("/search/suggest")
+async def suggest(
+    s: str = Query(..., alias="s", description="Partially typed search term"),
+    limit: int = Query(SUGGEST_LIMIT, ge=1, le=20, description="Maximum number of completions and documents")
+):
+    """
+    Typeahead for live search: completions of the last word and the best
+    matching pages, without snippets or templates
+    """
+    return await run_in_search_pool(lambda: run_suggest(get_index(), s.replace('+', ' '), limit))
+
+def run_suggest(index: Union[SearchIndex, SearchView], s: str, limit: int) -> dict:
+    """
+    Complete the last word of s and rank pages for the top completions.
+    Only a bare word is completed: when s ends in an excluded word or a
+    phrase there is nothing to suggest. Pages are ranked among at most
+    SUGGEST_CANDIDATES of the matching ones, those with a completion in
+    their title first.
+    """
+    view = as_view(index)
+    query = parse_query(s)
+    if not query.prefix:
+        return {"query": s, "suggestions": [], "documents": []}
+    # Completions are ranked among the pages with the other bare words
+    completions = view.complete(' '.join(query.words), limit)
+    # Suggestions keep everything typed before the word being completed
+    words = list(TOKEN_RE.finditer(s))
+    prefix = s[:words[-1].start()] if words else ''
+    
+    documents = []
+    if completions:
+        # The word being typed matches any of its top completions
+        top = [term for term, _ in completions]
+        query = SearchQuery(query.words[:-1] + top[:1], query.phrases, query.excluded, False, {top[0]: top[1:]})
+        for hit in view.hits(query, "*", "live", candidates=SUGGEST_CANDIDATES):
+            documents.append({'title': hit.title, 'href': hit.path})
+            if len(documents) >= limit:
+                break
+    
+    return {
+        "query": s,
+        "suggestions": [{'text': prefix + term, 'count': count} for term, count in completions],
+        "documents": documents
+    }
+
 def get_file_extension(filename: str) -> str:
     """Get the extension of a file"""
     return Path(filename).suffix.lstrip('.')
@@ -52,161 +232,194 @@ def find_in_text(text: str, search_term: str, case_sensitive: bool = False) -> l
 async def search(
     s: str = Query(..., alias="s", description="Search term"),
     filter_pattern: str = Query("*", alias="filter", description="Filter pattern for file search"),
-    template: str = Query("<h5 class='search_title'><a target='_top' href='#{href}' class='search_link'>#{title}</a></h5><p>...#{token}...</p><p class='match'><em>Terms matched: #{count} - URL: #{href}</em></p>", description="Result template"),
+    template: str = Query(DEFAULT_TEMPLATE, description="Result template"),
     live_count: Optional[int] = Query(None, alias="liveCount", description="Limit for live search results"),
-    live_search: Optional[str] = Query(None, alias="liveSearch", description="Live search flag")
+    live_search: Optional[str] = Query(None, alias="liveSearch", description="Live search flag"),
+    fuzzy: bool = Query(False, description="Also match words within one or two typos"),
+    stream: Optional[str] = Query(None, pattern="^(ndjson|sse)$", description="Stream results as NDJSON or Server-Sent Events"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Results per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    if_none_match: Optional[str] = Header(None, description="ETag of a response the client already has"),
+    accept_encoding: Optional[str] = Header(None, description="Encodings the client accepts")
 ):
     """
     Search functionality similar to rd-search.php
+    
+    Responses carry an ETag derived from the index generation and the
+    normalized parameters; a request presenting it again in If-None-Match
+    gets 304 Not Modified without the query being run. Responses of at
+    least compress_min_size bytes are compressed when the client accepts it.
     """
     logger.info(f"Search request received with query: {s}")
     if not s or s == "?s=":
         s = ""
     
-    # Replace + with space in search term
-    search_term = s.replace('+', ' ')
-    search_term_lower = search_term.lower()
-    search_term_length = len(search_term)
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    # Starting search directory (relative to the web root)
-    search_dir = ".."  # Adjust this based on your site structure
+    if stream:
+        events = search_events(s, filter_pattern, template, live_count, live_search, fuzzy, limit, cursor)
+        return StreamingResponse(stream_search(events, stream), media_type=STREAM_MEDIA_TYPES[stream])
     
-    # File extensions to search in
-    search_in = ['html', 'htm']
+    key = search_key(s, filter_pattern, template, live_count, live_search, fuzzy, limit, cursor)
+    index, fingerprint, etag = await run_in_search_pool(search_etag, key)
+    encoding = choose_encoding(accept_encoding, [encoding for encoding, _ in ENCODINGS])
+    headers = {"Cache-Control": settings.search_cache_control, "Vary": "Accept-Encoding"}
+    if if_none_match:
+        # Whether the response gets compressed is only known once it is
+        # built, so either representation the client may hold is current
+        current = matching_etag(if_none_match, [etag] + ([encoded_etag(etag, encoding)] if encoding else []))
+        if current is not None:
+            return Response(status_code=304, headers={"ETag": current, **headers})
     
-    # Get all files to search
-    files = list_files(search_dir, search_in)
-    logger.info(f"Found {len(files)} files to search in")
+    # Requests are coalesced by ETag, so they share a response only when
+    # they were also answered from the same index generation
+    content = await search_flights.run(
+        etag,
+        lambda: run_in_search_pool(cached_search, s, filter_pattern, template, live_count, live_search, fuzzy,
+                                   limit, cursor, index, fingerprint)
+    )
+    if encoding and len(content) >= settings.compress_min_size:
+        content = await run_in_search_pool(compress_response, etag, content, encoding)
+        headers["Content-Encoding"] = encoding
+        etag = encoded_etag(etag, encoding)
+    return Response(content=content, media_type="application/json", headers={"ETag": etag, **headers})
+
+def compress_response(etag: str, content: bytes, encoding: str) -> bytes:
+    """content compressed with encoding, from the compressed cache when possible"""
+    compressed = compressed_cache.get((etag, encoding)) if compressed_cache is not None else None
+    if compressed is None:
+        compressed = compress(content, encoding)
+        if compressed_cache is not None:
+            compressed_cache.put((etag, encoding), compressed)
+    return compressed
+
+def search_events(s: str, filter_pattern: str, template: str, live_count: Optional[int],
+                  live_search: Optional[str], fuzzy: bool, limit: Optional[int], cursor: Optional[str]):
+    """iter_search() over the current index, resolved on the first step"""
+    yield from iter_search(get_index(), s, filter_pattern, template, live_count, live_search, fuzzy, limit, cursor)
+
+async def stream_search(events, stream: str):
+    """
+    Send search events as they are produced. Every step of the generator
+    runs in the search pool, so the first result goes out before the
+    rest are ranked and formatted. Streamed responses bypass the result
+    cache.
+    """
+    while True:
+        event = await run_in_search_pool(next, events, None)
+        if event is None:
+            break
+        name, data = event
+        if stream == "sse":
+            yield b"event: " + name.encode("ascii") + b"\ndata: " + serialize(data) + b"\n\n"
+        else:
+            yield serialize({"type": name, **data}) + b"\n"
+
+def search_key(s: str, filter_pattern: str, template: str, live_count: Optional[int],
+               live_search: Optional[str], fuzzy: bool, limit: Optional[int], cursor: Optional[str]) -> tuple:
+    """Normalized search parameters: requests with equal keys get the same response"""
+    # liveCount only has an effect for live searches
+    return (s, filter_pattern, template, live_count if live_search else None, bool(live_search), fuzzy, limit, cursor)
+
+def search_fingerprint(index: Union[SearchIndex, SearchView]) -> str:
+    """Identifies the code and the state of the corpus responses from index depend on"""
+    fingerprint = f"{RESPONSE_FORMAT}:{index.fingerprint}"
+    # A reindex in any worker bumps the shared generation, which retires
+    # the responses all workers cached under the previous one
+    if shared_cache is not None:
+        fingerprint = f"{fingerprint}:{shared_cache.generation}"
+    return fingerprint
+
+def search_etag(key: tuple) -> tuple:
+    """
+    The current index, its fingerprint and the strong ETag of the
+    response to the search with key. The request answers from this
+    fingerprint, so the response is cached under the key its ETag names.
+    """
+    index = get_index()
+    fingerprint = search_fingerprint(index)
+    return index, fingerprint, '"' + ResultCache.make_key(fingerprint, *key) + '"'
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Strong ETag of the response with ETag etag compressed with encoding"""
+    return f'{etag[:-1]}-{encoding}"'
+
+def matching_etag(if_none_match: str, etags: list) -> Optional[str]:
+    """The first of etags an If-None-Match header lists, compared weakly as RFC 9110 requires"""
+    if if_none_match.strip() == "*":
+        return etags[0]
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
     
-    final_result = []
-    file_count = 0
+    listed = {opaque(tag) for tag in if_none_match.split(",")}
+    return next((etag for etag in etags if etag in listed), None)
+
+def cached_search(s: str, filter_pattern: str, template: str, live_count: Optional[int],
+                  live_search: Optional[str], fuzzy: bool = False, limit: Optional[int] = None,
+                  cursor: Optional[str] = None, index: Union[SearchIndex, SearchView, None] = None,
+                  fingerprint: Optional[str] = None) -> bytes:
+    """
+    Return the serialized search response, from the result cache when
+    possible. index defaults to the current one, fingerprint to the
+    search_fingerprint() of index.
+    """
+    if index is None:
+        index = get_index()
+    if result_cache is None:
+        return serialize(run_search(index, s, filter_pattern, template, live_count, live_search, fuzzy, limit, cursor))
     
-    for file_path in files:
-        # Skip if filter doesn't match
-        if filter_pattern != "*" and not Path(file_path).match(filter_pattern):
-            continue
-            
-        try:
-            # Check file size
-            if os.path.getsize(file_path) == 0:
-                continue
-                
-            # Read file content
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                contents = f.read()
-            
-            # Extract page title
-            title_match = re.search(r'<title>(.*?)</title>', contents, re.IGNORECASE)
-            page_title = title_match.group(1) if title_match else ""
-            
-            # Extract body content
-            body_match = re.search(r'<body.*?>(.*?)</body>', contents, re.DOTALL | re.IGNORECASE)
-            body_content = body_match.group(1) if body_match else contents
-            
-            # Remove HTML tags and normalize whitespace
-            clean_content = re.sub(r'<[^>]+>', ' ', body_content)
-            clean_content = re.sub(r'\s+', ' ', clean_content).strip()
-            
-            # Find occurrences of search term
-            found_matches = []
-            for match in re.finditer(re.escape(search_term), clean_content, re.IGNORECASE):
-                found_matches.append((match.group(), match.start(), match.end()))
-            
-            # Process results
-            result_item = {
-                'page_title': page_title,
-                'file_name': file_path,
-                'search_result': []
-            }
-            
-            # Add meta information based on template tokens
-            template_tokens = re.findall(r'#\{((?!title|href|token|count)[a-z]*)\}', template, re.IGNORECASE)
-            for token in template_tokens:
-                meta_match = re.search(r'<meta\s+name=[\'"]' + re.escape(token) + r'[\'"]\s+content=[\'"](.*)[\'"]\s*>', contents, re.IGNORECASE)
-                if meta_match:
-                    result_item[token] = meta_match.group(1)
-            
-            # Generate result snippets
-            for match in found_matches:
-                _, pos_start, pos_end = match
-                
-                # Calculate snippet boundaries
-                side_chars = SIDE_CHARS
-                if pos_start < SIDE_CHARS:
-                    actual_start = 0
-                    side_chars = pos_start
-                else:
-                    actual_start = pos_start - side_chars
-                
-                if live_search:
-                    pos_end = pos_start + search_term_length + SIDE_CHARS + 15
-                else:
-                    pos_end = pos_start + search_term_length + SIDE_CHARS * 9
-                
-                snippet = clean_content[actual_start:pos_end]
-                
-                # Highlight search term in snippet
-                highlighted_snippet = re.sub(
-                    re.escape(search_term),
-                    f'<span class="search">{search_term}</span>',
-                    snippet,
-                    flags=re.IGNORECASE
-                )
-                
-                result_item['search_result'].append(highlighted_snippet)
-            
-            # Add empty result if no matches found
-            if not found_matches:
-                result_item['search_result'].append('')
-                
-            final_result.append(result_item)
-            file_count += 1
-            
-        except Exception as e:
-            # Skip files that can't be read
-            logger.error(f"Error reading file {file_path}: {str(e)}")
-            continue
-    
-    # Sort results by number of matches (descending)
-    final_result.sort(key=lambda x: len(x['search_result']), reverse=True)
-    
-    # Prepare response
+    if fingerprint is None:
+        fingerprint = search_fingerprint(index)
+    key = ResultCache.make_key(fingerprint, *search_key(s, filter_pattern, template, live_count, live_search, fuzzy,
+                                                       limit, cursor))
+    content = result_cache.get(fingerprint, key)
+    if content is None:
+        content = serialize(run_search(index, s, filter_pattern, template, live_count, live_search, fuzzy,
+                                       limit, cursor))
+        result_cache.put(fingerprint, key, content)
+    return content
+
+def encode_cursor(key: tuple) -> str:
+    """Opaque cursor for the position (score, doc_id) of the last result of a page"""
+    return base64.urlsafe_b64encode(json.dumps(key).encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor(); raises ValueError for a malformed cursor"""
+    try:
+        score, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    if not isinstance(score, (int, float)) or not isinstance(doc_id, int):
+        raise ValueError(f"invalid cursor: {cursor}")
+    return float(score), doc_id
+
+def serialize(response: dict) -> bytes:
+    """Encode a response the same way as FastAPI's JSONResponse"""
+    return json.dumps(response, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def run_search(index: Union[SearchIndex, SearchView], s: str, filter_pattern: str, template: str,
+               live_count: Optional[int], live_search: Optional[str], fuzzy: bool = False,
+               limit: Optional[int] = None, cursor: Optional[str] = None) -> dict:
+    """Run a search query against one generation of the index"""
+    search_term = s.replace('+', ' ')
     results = []
     match_count = 0
+    total_matches = 0
+    next_cursor = None
     
-    for item in final_result:
-        if item['search_result'] and any(item['search_result']):
-            match_count += 1
-            # Limit results if live search is enabled
-            if live_search and live_count and len(results) >= live_count:
-                continue
-                
-            # Apply template to format result
-            replacement_values = [
-                item['page_title'],
-                item['file_name'],
-                item['search_result'][0] if item['search_result'] else '',
-                len(item['search_result'])
-            ]
-            
-            formatted_result = template
-            formatted_result = formatted_result.replace('#{title}', replacement_values[0])
-            formatted_result = formatted_result.replace('#{href}', replacement_values[1])
-            formatted_result = formatted_result.replace('#{token}', replacement_values[2])
-            formatted_result = formatted_result.replace('#{count}', str(replacement_values[3]))
-            
-            # Replace any additional template tokens
-            for token in template_tokens:
-                token_value = item.get(token, '')
-                formatted_result = formatted_result.replace(f'#{{{token}}}', str(token_value))
-            
-            results.append({
-                'title': item['page_title'],
-                'href': item['file_name'],
-                'snippet': item['search_result'][0] if item['search_result'] else '',
-                'count': len(item['search_result']),
-                'formatted': formatted_result
-            })
+    for event, data in iter_search(index, s, filter_pattern, template, live_count, live_search, fuzzy,
+                                   limit, cursor):
+        if event == "result":
+            results.append(data)
+        else:
+            match_count = data['results_count']
+            total_matches = data['total_matches']
+            next_cursor = data['next_cursor']
     
     # Prepare final response
     response_html = f"""
@@ -230,7 +443,7 @@ async def search(
         response_html += f"""
         <li class="search_all">
             <a href='search-results.html?s={s}&filter={filter_pattern}' class="search_submit">
-                See other {sum(len(item['search_result']) for item in final_result)} {f"result on " if sum(len(item['search_result']) for item in final_result) < 2 else "results"}
+                See other {total_matches} {f"result on " if total_matches < 2 else "results"}
             </a>
         </li>
         """
@@ -244,7 +457,71 @@ async def search(
     return {
         "query": search_term,
         "results_count": match_count,
-        "total_matches": sum(len(item['search_result']) for item in final_result),
+        "total_matches": total_matches,
         "results": results,
+        "next_cursor": next_cursor,
         "html": response_html
-    }
\ No newline at end of file
+    }
+
+def iter_search(index: Union[SearchIndex, SearchView], s: str, filter_pattern: str, template: str,
+                live_count: Optional[int], live_search: Optional[str], fuzzy: bool = False,
+                limit: Optional[int] = None, cursor: Optional[str] = None):
+    """
+    Yield ("result", result) for every formatted result in relevance order
+    as soon as it is found, then ("summary", counts). Nothing is kept per
+    result, so memory does not grow with the number of results.
+    
+    With limit, only one page is formatted; the summary carries the cursor
+    of the next page. Results are ordered by score, then document id, so
+    pages neither overlap nor skip results of the same index generation.
+    """
+    # Replace + with space in search term
+    search_term = s.replace('+', ' ')
+    view = as_view(index)
+    # Words, "phrases" and -exclusions
+    query = parse_query(search_term)
+    if fuzzy:
+        query = view.fuzzy_query(query)
+    
+    # Compiled once per distinct template; extra tokens come from the page meta tags
+    plan = compile_template(template)
+    
+    # Live searches only need the best liveCount pages, paginated ones a page
+    limits = [n for n in (live_count if live_search else None, limit) if n]
+    max_results = min(limits) if limits else None
+    
+    match_count = 0
+    total_matches = 0
+    last_key = None
+    
+    hits = view.hits(query, filter_pattern, live_search, decode_cursor(cursor) if cursor else None)
+    for hit in hits:
+        match_count += 1
+        total_matches += hit.count
+        last_key = hit.key
+        yield "result", format_result(plan, hit)
+        if max_results is not None and match_count >= max_results:
+            break
+    
+    # Pages below the limit are counted from the index instead of scanned
+    unseen_count, unseen_matches, more = hits.unseen()
+    match_count += unseen_count
+    total_matches += unseen_matches
+    
+    yield "summary", {
+        "query": search_term,
+        "results_count": match_count,
+        "total_matches": total_matches,
+        "next_cursor": encode_cursor(last_key) if more and last_key is not None else None
+    }
+
+def format_result(plan: TemplatePlan, hit: SearchHit) -> dict:
+    """Apply the result template to a found page"""
+    fields = {'title': hit.title, 'href': hit.path, 'token': hit.snippet, 'count': str(hit.count)}
+    return {
+        'title': hit.title,
+        'href': hit.path,
+        'snippet': hit.snippet,
+        'count': hit.count,
+        'formatted': plan.render(fields, hit.meta)
+    }
@@ -0,0 +1,227 @@
+"""
+Search backends.
+
+A backend keeps a searchable copy of the site pages in sync with the files
+(see IndexRefresher) and hands out views of it. A view answers queries
+against one state of the corpus:
+
+    fingerprint          identifies that state, e.g. in result cache keys
+    hits()               matching pages in relevance order, see SearchHits
+    fuzzy_query()        the query with typo corrections
+    complete()           completions of the last word of a query
+    directories          documents by directory, for pruning filters
+    order()              sort key of a hit key, for merging hits of shards
+    describe()           numbers for /api/search/stats
+
+IndexView serves the in-memory inverted index; SqliteStore (search_sqlite)
+an SQLite FTS5 database; ShardedView (search_shards) several of them.
+"""
+import abc
+import fnmatch
+import functools
+from pathlib import PurePath
+from typing import Any, Callable, Dict, Iterator, List, Optional, Pattern, Set, Tuple
+from search_index import SearchIndex, SearchQuery
+
+SIDE_CHARS = 15
+
+# Position of a hit in the relevance order: (score, document id)
+HitKey = Tuple[float, int]
+
+
+class SearchHit:
+    """A matching page; its snippet is only built when it is read"""
+
+    __slots__ = ('path', 'title', 'meta', 'count', 'key', '_snippet')
+
+    def __init__(self, path: str, title: str, meta: Dict[str, str], count: int, key: HitKey,
+                 snippet: Callable[[], str]):
+        self.path = path
+        self.title = title
+        self.meta = meta
+        self.count = count
+        self.key = key
+        self._snippet = snippet
+
+    @property
+    def snippet(self) -> str:
+        if callable(self._snippet):
+            self._snippet = self._snippet()
+        return self._snippet
+
+
+class SearchHits(abc.ABC):
+    """
+    Hits of a query, best first. Iteration may stop early; unseen() then
+    tells how many matching pages and matches were not yielded and whether
+    any of them come after the last yielded hit.
+    """
+
+    @abc.abstractmethod
+    def __iter__(self) -> Iterator[SearchHit]:
+        """The hits, best first"""
+
+    @abc.abstractmethod
+    def unseen(self) -> Tuple[int, int, bool]:
+        """(pages, matches, more after the last yielded hit) not yielded"""
+
+
+class SearchView(abc.ABC):
+    """Queries against one state of a backend"""
+
+    @property
+    @abc.abstractmethod
+    def fingerprint(self) -> str:
+        """Identifies the state of the corpus the view answers from"""
+
+    @abc.abstractmethod
+    def hits(self, query: SearchQuery, filter_pattern: str, live_search: Optional[str],
+             cursor: Optional[HitKey] = None, candidates: Optional[int] = None) -> SearchHits:
+        """
+        Pages matching query and filter_pattern, after cursor when given.
+        With candidates, only about that many matching pages are ranked,
+        e.g. for typeahead, and the rest are neither yielded nor counted.
+        """
+
+    @abc.abstractmethod
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        """query with its words corrected to indexed terms"""
+
+    @abc.abstractmethod
+    def complete(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """Up to limit completions of the last word of query, with their page counts"""
+
+    @property
+    @abc.abstractmethod
+    def directories(self) -> Dict[str, List[Tuple[str, int]]]:
+        """(file name, doc id) of the documents in every directory"""
+
+    def order(self, key: HitKey) -> Tuple[float, int]:
+        """Ascending sort key of the hit with key"""
+        return key
+
+    @abc.abstractmethod
+    def describe(self) -> Dict[str, Any]:
+        """Numbers for /api/search/stats"""
+
+
+class PathFilter:
+    """
+    A filter glob, matching the paths Path(path).match(pattern) matches.
+
+    The pattern is split into its directory part, tested once per
+    directory, and its last component, tested per file name; so a filter
+    rules out whole directories (and shards) before any document is looked
+    at.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        parts = PurePath(pattern).parts
+        self.name = parts[-1] if parts else None
+        self.directory = str(PurePath(*parts[:-1])) if len(parts) > 1 else None
+
+    @property
+    def everything(self) -> bool:
+        return self.pattern == "*"
+
+    def allows_directory(self, directory: str) -> bool:
+        """Whether files directly in directory may match"""
+        return self.name is not None and (self.directory is None or PurePath(directory).match(self.directory))
+
+    def allows(self, directories: Dict[str, List[Tuple[str, int]]]) -> bool:
+        """Whether any of directories may hold a matching file"""
+        return self.everything or any(self.allows_directory(directory) for directory in directories)
+
+    def documents(self, directories: Dict[str, List[Tuple[str, int]]]) -> Optional[Set[int]]:
+        """Ids of the matching documents, or None when every document matches"""
+        if self.everything:
+            return None
+        return {doc_id for directory, files in directories.items() if self.allows_directory(directory)
+                for name, doc_id in files if fnmatch.fnmatch(name, self.name)}
+
+
+def make_snippet(text: str, match, pattern: Pattern, live_search: Optional[str]) -> str:
+    """Cut the text around a match and highlight every query term in it"""
+    # Calculate snippet boundaries
+    actual_start = max(match.start() - SIDE_CHARS, 0)
+    if live_search:
+        pos_end = match.end() + SIDE_CHARS + 15
+    else:
+        pos_end = match.end() + SIDE_CHARS * 9
+
+    # Highlight every query word and phrase in snippet
+    return pattern.sub(r'<span class="search">\g<0></span>', text[actual_start:pos_end])
+
+
+class IndexHits(SearchHits):
+    """Hits from a Ranking; snippets are cut from the indexed page text"""
+
+    def __init__(self, index: SearchIndex, query: SearchQuery, filter_pattern: str,
+                 live_search: Optional[str], cursor: Optional[HitKey], candidates: Optional[int] = None):
+        self.index = index
+        self.live_search = live_search
+        self.pattern = query.pattern()
+        # The filter only narrows the candidates, so excluded pages are never scored
+        self.ranking = index.rank_query(query, PathFilter(filter_pattern).documents(index.directories), candidates)
+        # Pages before the cursor are counted from the index, like the ones after the page
+        self.skipped = self.ranking.skip_past(*cursor) if cursor else []
+
+    def __iter__(self) -> Iterator[SearchHit]:
+        for doc_id in self.ranking:
+            document = self.index.documents[doc_id]
+            # Only the first match is needed for the snippet; the number of
+            # matches comes from the index
+            match = self.pattern.search(document.text)
+            if match is None:
+                continue
+            yield SearchHit(document.path, document.title, document.meta, self.ranking.matches(doc_id),
+                            self.ranking.key(doc_id),
+                            functools.partial(make_snippet, document.text, match, self.pattern, self.live_search))
+
+    def unseen(self) -> Tuple[int, int, bool]:
+        count = matches = 0
+        more = False
+        for doc_ids, after in ((self.ranking.remaining(), True), (self.skipped, False)):
+            more = more or (after and bool(doc_ids))
+            count += len(doc_ids)
+            matches += sum(self.ranking.matches(doc_id) for doc_id in doc_ids)
+        return count, matches, more
+
+
+class IndexView(SearchView):
+    """View of one SearchIndex generation"""
+
+    def __init__(self, index: SearchIndex):
+        self.index = index
+
+    @property
+    def fingerprint(self) -> str:
+        return self.index.fingerprint
+
+    def hits(self, query: SearchQuery, filter_pattern: str, live_search: Optional[str],
+             cursor: Optional[HitKey] = None, candidates: Optional[int] = None) -> SearchHits:
+        return IndexHits(self.index, query, filter_pattern, live_search, cursor, candidates)
+
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        return self.index.fuzzy_query(query)
+
+    def complete(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        return self.index.complete(query, limit)
+
+    @property
+    def directories(self) -> Dict[str, List[Tuple[str, int]]]:
+        return self.index.directories
+
+    def order(self, key: HitKey) -> Tuple[float, int]:
+        # Best score first
+        return -key[0], key[1]
+
+    def describe(self) -> Dict[str, Any]:
+        return {"backend": "index", "generation": self.index.generation,
+                "documents": len(self.index), "terms": len(self.index.terms)}
+
+
+def as_view(index) -> SearchView:
+    """Wrap a SearchIndex into a view; other backends are views already"""
+    return IndexView(index) if isinstance(index, SearchIndex) else index
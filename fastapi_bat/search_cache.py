@@ -0,0 +1,370 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+# redis is optional: without it (or without REDIS_URL) caching stays per process
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# How many of the most recent corpus fingerprints ResultCache remembers
+# as seen, so that a request still answering from one of them does not
+# retire the newer ones
+SEEN_FINGERPRINTS = 32
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its values.
+
+    sizeof tells how many bytes a value accounts for; the least recently used
+    entries are evicted until the total fits into max_size.
+    """
+
+    def __init__(self, max_size: int, sizeof: Callable[[Any], int] = len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Errors of a shared cache client that make it fall back to the local tiers
+SHARED_ERRORS = (OSError,) + ((redis.RedisError,) if redis is not None else ())
+
+
+class SharedCache:
+    """
+    Search state shared by all workers through Redis: an index generation
+    counter and serialized search responses.
+
+    A worker that publishes a new index generation bumps the counter;
+    the others notice the new value on their next request, refresh their
+    index and stop using results cached under the old value. When Redis
+    fails, the calls return as if nothing were shared and the next attempt
+    is made after retry_interval seconds, so searches never wait on a dead
+    server.
+    """
+
+    def __init__(self, client, prefix: str = "bat:search:", retry_interval: float = 30):
+        self.client = client
+        self.prefix = prefix
+        self.retry_interval = retry_interval
+        # Last counter value this worker read or wrote
+        self.generation: Optional[int] = None
+        self.hits = 0
+        self.errors = 0
+        self._retry_at = 0.0
+
+    @classmethod
+    def from_url(cls, url: Optional[str], **kwargs) -> Optional["SharedCache"]:
+        """Connect to the Redis server at url; None when not configured or redis is not installed"""
+        if not url:
+            return None
+        if redis is None:
+            logger.warning("REDIS_URL is set but the redis package is not installed, search cache stays per process")
+            return None
+        return cls(redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5), **kwargs)
+
+    @property
+    def available(self) -> bool:
+        return time.time() >= self._retry_at
+
+    def _call(self, method: str, *args, **kwargs) -> Any:
+        """Run a client command; None while Redis is failing"""
+        if not self.available:
+            return None
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except SHARED_ERRORS as e:
+            self.errors += 1
+            self._retry_at = time.time() + self.retry_interval
+            logger.warning(f"Shared search cache unavailable, retrying in {self.retry_interval}s: {str(e)}")
+            return None
+
+    def poll(self) -> bool:
+        """Read the generation counter; True when another worker bumped it since the last read"""
+        value = self._call('get', self.prefix + "generation")
+        if value is None and not self.available:
+            return False
+        generation = int(value or 0)
+        changed = self.generation is not None and generation != self.generation
+        self.generation = generation
+        return changed
+
+    def bump(self):
+        """Announce a new index generation to the other workers"""
+        value = self._call('incr', self.prefix + "generation")
+        if value is not None:
+            self.generation = int(value)
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._call('get', self.prefix + key)
+        if value is not None:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes, lifetime: int):
+        if lifetime > 0:
+            self._call('set', self.prefix + key, value, ex=lifetime)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"generation": self.generation, "hits": self.hits, "errors": self.errors,
+                "available": self.available}
+
+
+class ResultCache:
+    """
+    Multi-tier cache of serialized search responses.
+
+    Entries live in an in-process LRU; when a SharedCache is given, in Redis
+    for all workers; and when cache_dir is given, in files under it, so they
+    survive restarts and are shared by workers on the same host. Every entry
+    expires after lifetime seconds. Keys include the corpus fingerprint, so
+    a changed site never gets stale results.
+
+    Cache files live in a directory per fingerprint; the directories of
+    other fingerprints are removed when a fingerprint not seen before
+    arrives, and the oldest files are removed once the files take more
+    than disk_max_size bytes. A request still answering from an older
+    fingerprint (e.g. in flight during a reindex, or from a worker that
+    has not refreshed yet) keeps the entries of the newer ones.
+    """
+
+    def __init__(self, lifetime: int, max_size: int, cache_dir: Optional[str] = None,
+                 shared: Optional[SharedCache] = None, disk_max_size: int = 64 * 1024 * 1024):
+        self.lifetime = lifetime
+        self.memory = LRUCache(max_size, sizeof=lambda entry: len(entry[1]))
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.shared = shared
+        self.disk_max_size = disk_max_size
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        # Bytes written to the current directory since it was last measured
+        self._disk_size = 0
+        self._disk_lock = threading.Lock()
+        self._fingerprints: "OrderedDict[str, None]" = OrderedDict()
+        self._fingerprint_lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(fingerprint: str, *params: Any) -> str:
+        return hashlib.sha256(json.dumps([fingerprint, *params]).encode('utf-8')).hexdigest()
+
+    def get(self, fingerprint: str, key: str) -> Optional[bytes]:
+        self._check_fingerprint(fingerprint)
+        now = time.time()
+
+        entry = self.memory.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        if self.shared is not None:
+            entry = self._decode(self.shared.get(f"result:{key}"))
+            if entry is not None and entry[0] > now:
+                self.memory.put(key, entry)
+                return entry[1]
+
+        if self.cache_dir is not None:
+            path = self._disk_dir(fingerprint) / f"{key}.cache"
+            try:
+                with open(path, 'rb') as f:
+                    expires = float(f.readline())
+                    content = f.read()
+            except (OSError, ValueError):
+                return None
+            if expires > now:
+                self.disk_hits += 1
+                self.memory.put(key, (expires, content))
+                return content
+            path.unlink(missing_ok=True)
+        return None
+
+    def put(self, fingerprint: str, key: str, content: bytes):
+        self._check_fingerprint(fingerprint)
+        expires = time.time() + self.lifetime
+        self.memory.put(key, (expires, content))
+
+        if self.shared is not None:
+            self.shared.put(f"result:{key}", f"{expires}\n".encode('ascii') + content, self.lifetime)
+
+        if self.cache_dir is not None:
+            directory = self._disk_dir(fingerprint)
+            path = directory / f"{key}.cache"
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                directory.mkdir(exist_ok=True)
+                with open(tmp_path, 'wb') as f:
+                    f.write(f"{expires}\n".encode('ascii'))
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not write search cache file {path}: {str(e)}")
+                return
+            with self._disk_lock:
+                self._disk_size += len(content)
+                if self._disk_size > self.disk_max_size:
+                    self._trim_disk(directory)
+
+    def _disk_dir(self, fingerprint: str) -> Path:
+        return self.cache_dir / hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:16]
+
+    def _trim_disk(self, directory: Path):
+        """Remove the oldest cache files until they take at most 3/4 of disk_max_size"""
+        files = []
+        for path in directory.glob("*.cache"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        size = sum(file_size for _, file_size, _ in files)
+        files.sort()
+        for _, file_size, path in files:
+            if size <= self.disk_max_size * 3 // 4:
+                break
+            path.unlink(missing_ok=True)
+            size -= file_size
+            self.disk_evictions += 1
+        self._disk_size = size
+
+    @staticmethod
+    def _decode(value: Optional[bytes]) -> Optional[tuple]:
+        """(expires, content) from an entry stored like the cache files"""
+        if value is None:
+            return None
+        header, _, content = value.partition(b"\n")
+        try:
+            return float(header), content
+        except ValueError:
+            return None
+
+    def _check_fingerprint(self, fingerprint: str):
+        """Drop the entries of other fingerprints once a newer corpus shows up"""
+        with self._fingerprint_lock:
+            if fingerprint in self._fingerprints:
+                return
+            self._fingerprints[fingerprint] = None
+            if len(self._fingerprints) > SEEN_FINGERPRINTS:
+                self._fingerprints.popitem(last=False)
+            self.memory.clear()
+            if self.cache_dir is not None:
+                self._remove_other_dirs(self._disk_dir(fingerprint))
+
+    def _remove_other_dirs(self, current: Path):
+        with self._disk_lock:
+            try:
+                entries = list(self.cache_dir.iterdir())
+            except OSError:
+                return
+            for entry in entries:
+                if entry == current:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    # Files of the layout without fingerprint directories
+                    entry.unlink(missing_ok=True)
+            self._disk_size = 0
+            self._trim_disk(current)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.memory.stats(), "disk_hits": self.disk_hits, "disk_evictions": self.disk_evictions,
+                "disk": self.cache_dir is not None,
+                "shared": self.shared.stats() if self.shared is not None else None}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests.
+
+    The first call with a key starts the computation as a task; calls with
+    the same key made before it finishes await that task instead of
+    starting their own, and all of them get its result or exception. A
+    caller that is cancelled (e.g. the client went away) does not cancel
+    the computation the others are waiting for. Must be used from one
+    event loop.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.coalesced = 0
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        self.requests += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(func())
+            flight.add_done_callback(lambda done: self._landed(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(flight)
+
+    def _landed(self, key: Hashable, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Mark the exception as retrieved when every caller was cancelled
+        if not flight.cancelled():
+            flight.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "coalesced": self.coalesced, "in_flight": len(self._flights)}
@@ -0,0 +1,1010 @@
+import hashlib
+import heapq
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Pattern, Sequence, Set, Tuple
+from search_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# (mtime_ns, size) of an indexed file, used to detect changes
+FileStat = Tuple[int, int]
+
+# Below this many files a process pool costs more than it saves
+PARALLEL_MIN_FILES = 200
+
+# BM25 parameters; a title occurrence weighs as much as TITLE_BOOST body ones
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_BOOST = 3.0
+
+# Typo tolerance: words shorter than FUZZY_MIN_LENGTH are never corrected,
+# longer ones allow one edit, or two from FUZZY_TWO_EDITS_LENGTH characters
+FUZZY_MIN_LENGTH = 4
+FUZZY_TWO_EDITS_LENGTH = 8
+FUZZY_MAX_TERMS = 8
+
+# Pages are read and parsed in chunks of this many characters
+CHUNK_SIZE = 64 * 1024
+# Elements whose content is never shown to visitors
+SKIPPED_TAGS = ('script', 'style')
+
+TOKEN_RE = re.compile(r'\w+')
+# A query token: optional exclusion sign, then a quoted phrase or a bare word
+QUERY_RE = re.compile(r'(-?)(?:"([^"]*)"?|([^\s"]+))')
+
+
+class Document:
+    """A parsed page: title, cleaned body text and meta tags"""
+
+    __slots__ = ('path', 'title', 'text', 'meta')
+
+    def __init__(self, path: str, title: str, text: str, meta: Dict[str, str]):
+        self.path = path
+        self.title = title
+        self.text = text
+        self.meta = meta
+
+    @property
+    def size(self) -> int:
+        """Approximate memory footprint, used to bound the document cache"""
+        return (len(self.path) + len(self.title) + len(self.text)
+                + sum(len(name) + len(value) for name, value in self.meta.items()))
+
+
+# path, title, text and meta tags (JSON) of every stored document
+DOCUMENT_FIELDS = 4
+
+
+class _StoreBuffer:
+    """UTF-8 fields of documents back to back, and the offsets between them"""
+
+    def __init__(self, data: bytes = b'', offsets: Optional[array] = None):
+        self.data = bytearray(data)
+        self.offsets = array('Q', [0]) if offsets is None else offsets
+
+    def head(self, count: int) -> "_StoreBuffer":
+        """Copy of the fields of the first count documents"""
+        end = count * DOCUMENT_FIELDS
+        return _StoreBuffer(self.data[:self.offsets[end]], self.offsets[:end + 1])
+
+
+class DocumentStore:
+    """
+    The documents of one index generation in compact form.
+
+    Every field of every document is appended UTF-8 encoded to one
+    contiguous buffer, found through an array of offsets: a stored page
+    costs its encoded size plus 32 bytes rather than a Document with four
+    strings and a dict. Documents are decoded on access, so only pages
+    actually shown are turned back into Python objects.
+
+    The next generation shares the buffer and appends to it; removed
+    documents leave a None slot and their bytes, which compacted() drops
+    once they make up more than MAX_DEAD_SHARE of the buffer.
+    """
+
+    MAX_DEAD_SHARE = 0.5
+
+    def __init__(self):
+        self._buffer = _StoreBuffer()
+        self._count = 0
+        self._removed: Set[int] = set()
+        # Bytes of the removed documents still in the buffer
+        self.dead_bytes = 0
+
+    def copy(self) -> "DocumentStore":
+        """Store for the next generation, sharing this buffer"""
+        store = DocumentStore()
+        store._buffer = self._buffer
+        store._count = self._count
+        store._removed = set(self._removed)
+        store.dead_bytes = self.dead_bytes
+        return store
+
+    @property
+    def size(self) -> int:
+        """Bytes of the buffer used by the documents of this store"""
+        return self._buffer.offsets[self._count * DOCUMENT_FIELDS]
+
+    @property
+    def wasteful(self) -> bool:
+        return self.dead_bytes > self.size * self.MAX_DEAD_SHARE
+
+    def compacted(self) -> "DocumentStore":
+        """
+        Copy of the store in a buffer of its own without the bytes of
+        removed documents; doc ids stay the same, removed slots become empty
+        """
+        store = DocumentStore()
+        data, offsets = self._buffer.data, self._buffer.offsets
+        buffer = store._buffer
+        for doc_id in range(self._count):
+            start = doc_id * DOCUMENT_FIELDS
+            if doc_id in self._removed:
+                buffer.offsets.extend([len(buffer.data)] * DOCUMENT_FIELDS)
+                continue
+            shift = len(buffer.data) - offsets[start]
+            buffer.data += data[offsets[start]:offsets[start + DOCUMENT_FIELDS]]
+            buffer.offsets.extend(offsets[i] + shift for i in range(start + 1, start + DOCUMENT_FIELDS + 1))
+        store._count = self._count
+        store._removed = set(self._removed)
+        return store
+
+    def __len__(self) -> int:
+        return self._count
+
+    def field(self, doc_id: int, field: int) -> str:
+        offsets = self._buffer.offsets
+        i = doc_id * DOCUMENT_FIELDS + field
+        return self._buffer.data[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogatepass')
+
+    def path(self, doc_id: int) -> str:
+        return self.field(doc_id, 0)
+
+    def __getitem__(self, doc_id: int) -> Optional[Document]:
+        if not 0 <= doc_id < self._count:
+            raise IndexError(doc_id)
+        if doc_id in self._removed:
+            return None
+        path, title, text, meta = (self.field(doc_id, field) for field in range(DOCUMENT_FIELDS))
+        return Document(path, title, text, json.loads(meta))
+
+    def __setitem__(self, doc_id: int, value: None):
+        """Remove a document: store[doc_id] = None"""
+        if value is not None:
+            raise ValueError("stored documents can only be removed")
+        if doc_id not in self._removed:
+            offsets = self._buffer.offsets
+            self.dead_bytes += offsets[(doc_id + 1) * DOCUMENT_FIELDS] - offsets[doc_id * DOCUMENT_FIELDS]
+            self._removed.add(doc_id)
+
+    def __iter__(self) -> Iterator[Optional[Document]]:
+        for doc_id in range(self._count):
+            yield self[doc_id]
+
+    def append(self, document: Optional[Document]):
+        buffer = self._buffer
+        if len(buffer.offsets) != self._count * DOCUMENT_FIELDS + 1:
+            # Another generation has appended to the shared buffer: fork it
+            buffer = self._buffer = buffer.head(self._count)
+        fields = ('',) * DOCUMENT_FIELDS if document is None else (
+            document.path, document.title, document.text, json.dumps(document.meta))
+        for value in fields:
+            buffer.data += value.encode('utf-8', 'surrogatepass')
+            buffer.offsets.append(len(buffer.data))
+        if document is None:
+            self._removed.add(self._count)
+        self._count += 1
+
+    def extend(self, documents: Iterable[Optional[Document]]):
+        for document in documents:
+            self.append(document)
+
+
+class TextExtractor(HTMLParser):
+    """
+    Incremental extractor of the title, meta tags and visible text of a page.
+
+    Feed it the page in chunks of any size: only the unparsed tail of the
+    last chunk and the current text run are buffered, and text is kept with
+    its whitespace collapsed. Text of <script> and <style> is skipped. When the page has
+    a <body>, only the text inside it is kept.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title_parts: List[str] = []
+        self.text_parts: List[str] = []
+        self.meta: Dict[str, str] = {}
+        # Text since the last tag; chunk boundaries may split it anywhere
+        self._run: List[str] = []
+        self._in_title = False
+        self._title_done = False
+        self._skipping: Optional[str] = None
+        self._body = False
+        self._body_done = False
+
+    def _flush(self):
+        """End the current text run: tags separate words, as if they were spaces"""
+        if self._run:
+            text = ' '.join(''.join(self._run).split())
+            self._run = []
+            if text:
+                self.text_parts.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag in SKIPPED_TAGS:
+            self._skipping = tag
+        elif tag == 'title' and not self._title_done:
+            self._in_title = True
+        elif tag == 'meta':
+            attributes = dict(attrs)
+            name, content = attributes.get('name'), attributes.get('content')
+            if name and content is not None:
+                self.meta[name.lower()] = content
+        elif tag == 'body' and not self._body:
+            # Text before the body (head, stray markup) is not searchable
+            self._body = True
+            self.text_parts = []
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag == self._skipping:
+            self._skipping = None
+        elif tag == 'title' and self._in_title:
+            self._in_title = False
+            self._title_done = True
+        elif tag == 'body' and self._body:
+            self._body_done = True
+
+    def handle_data(self, data):
+        if self._skipping or self._body_done:
+            return
+        if self._in_title:
+            self.title_parts.append(data)
+        self._run.append(data)
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def document(self, path: str) -> Document:
+        self.close()
+        self._flush()
+        return Document(path, ' '.join(''.join(self.title_parts).split()), ' '.join(self.text_parts), self.meta)
+
+
+def parse_html(path: str, contents: str) -> Document:
+    """Extract title, cleaned body text and meta tags from HTML source"""
+    extractor = TextExtractor()
+    extractor.feed(contents)
+    return extractor.document(path)
+
+
+def parse_document(file_path: str) -> Optional[Document]:
+    """Read and parse a single HTML file in chunks, skipping empty files"""
+    if os.path.getsize(file_path) == 0:
+        return None
+    extractor = TextExtractor()
+    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            extractor.feed(chunk)
+    return extractor.document(file_path)
+
+
+def file_stat(file_path: str) -> Optional[FileStat]:
+    """Return (mtime_ns, size) of a file, or None if it no longer exists"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def group_by_directory(doc_ids: Iterable[Tuple[str, int]]) -> Dict[str, List[Tuple[str, int]]]:
+    """Map every directory to the (file name, doc id) of the documents in it"""
+    directories: Dict[str, List[Tuple[str, int]]] = {}
+    for path, doc_id in doc_ids:
+        directory, name = os.path.split(path)
+        directories.setdefault(directory, []).append((name, doc_id))
+    return directories
+
+
+def load_document(file_path: str, stat: FileStat, cache: Optional[LRUCache] = None) -> Optional[Document]:
+    """
+    Parse a file for indexing, logging and skipping unreadable files.
+
+    Parsed documents are looked up in cache by (path, mtime_ns, size), so an
+    unchanged file is never read or parsed twice.
+    """
+    if stat[1] == 0:
+        return None
+    key = (file_path,) + stat
+    if cache is not None:
+        document = cache.get(key)
+        if document is not None:
+            return document
+    try:
+        document = parse_document(file_path)
+    except Exception as e:
+        # Skip files that can't be read
+        logger.error(f"Error reading file {file_path}: {str(e)}")
+        return None
+    if cache is not None and document is not None:
+        cache.put(key, document)
+    return document
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word terms"""
+    return [match.group().lower() for match in TOKEN_RE.finditer(text)]
+
+
+class SearchQuery:
+    """
+    A parsed query: words that must all occur, quoted phrases that must
+    occur verbatim, and excluded words or phrases. When prefix is set the
+    last of words is still being typed and matches as a prefix.
+    """
+
+    def __init__(self, words: List[str], phrases: List[List[str]], excluded: List[List[str]], prefix: bool,
+                 variants: Optional[Dict[str, List[str]]] = None):
+        self.words = words
+        self.phrases = phrases
+        self.excluded = excluded
+        self.prefix = prefix
+        # Vocabulary terms accepted in place of a mistyped word
+        self.variants = variants or {}
+
+    def pattern(self) -> Optional[Pattern]:
+        """
+        One case-insensitive pattern matching every required word and
+        phrase in page text, longest alternatives first
+        """
+        alternatives = sorted(
+            (r'\W+'.join(re.escape(word) for word in phrase) for phrase in self.phrases),
+            key=len, reverse=True
+        )
+        for i, word in enumerate(self.words):
+            is_prefix = self.prefix and i == len(self.words) - 1
+            alternatives.append(re.escape(word) if is_prefix else re.escape(word) + r'\b')
+            alternatives.extend(re.escape(variant) + r'\b' for variant in self.variants.get(word, ()))
+        if not alternatives:
+            return None
+        return re.compile(r'\b(?:' + '|'.join(alternatives) + ')', re.IGNORECASE)
+
+
+def trigrams(term: str) -> List[str]:
+    """Character trigrams of a term padded with $, one per character"""
+    padded = f"${term}$"
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein distance between a and b, or max_distance + 1 as soon as
+    it is certain to exceed max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+class TrigramIndex:
+    """
+    Trigram -> ids of the vocabulary terms containing it.
+
+    An edit changes at most three trigrams of a word, so a term within k
+    edits shares at least len(trigrams) - 3k of them; only terms passing
+    that count and the length difference are checked with edit_distance().
+    """
+
+    def __init__(self, terms: Sequence[str]):
+        self.terms = terms
+        self.grams: Dict[str, array] = {}
+        for term_id, term in enumerate(terms):
+            for gram in set(trigrams(term)):
+                if gram not in self.grams:
+                    self.grams[gram] = array('I')
+                self.grams[gram].append(term_id)
+
+    def similar(self, word: str, max_edits: int, limit: int = FUZZY_MAX_TERMS) -> List[str]:
+        """Up to limit vocabulary terms within max_edits of word, closest first"""
+        grams = set(trigrams(word))
+        needed = len(grams) - 3 * max_edits
+        if needed < 1:
+            return []
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for term_id in self.grams.get(gram, ()):
+                shared[term_id] = shared.get(term_id, 0) + 1
+
+        found = []
+        for term_id, count in shared.items():
+            if count < needed:
+                continue
+            term = self.terms[term_id]
+            distance = edit_distance(word, term, max_edits)
+            if distance <= max_edits:
+                found.append((distance, term))
+        return [term for _, term in heapq.nsmallest(limit, found)]
+
+
+def correct_query(query: SearchQuery, terms: Sequence[str],
+                  trigram_index: Callable[[], TrigramIndex]) -> SearchQuery:
+    """
+    Return query with typo corrections: every word that matches no term of
+    the sorted vocabulary gets the closest terms as variants. Phrases and
+    exclusions stay exact. trigram_index is only called when a word needs
+    correcting.
+    """
+    variants = {}
+    for i, word in enumerate(query.words):
+        if len(word) < FUZZY_MIN_LENGTH:
+            continue
+        # Known words (or, for the word being typed, known prefixes) stay as they are
+        is_prefix = query.prefix and i == len(query.words) - 1
+        j = bisect_left(terms, word)
+        if j < len(terms) and (terms[j] == word or is_prefix and terms[j].startswith(word)):
+            continue
+        max_edits = 2 if len(word) >= FUZZY_TWO_EDITS_LENGTH else 1
+        similar = trigram_index().similar(word, max_edits)
+        if similar:
+            variants[word] = similar
+    return SearchQuery(query.words, query.phrases, query.excluded, query.prefix, variants)
+
+
+def parse_query(query: str) -> SearchQuery:
+    """
+    Parse a query into words, "quoted phrases" and -excluded words or
+    -"phrases". A bare token that splits into several words (e.g. e-mail)
+    is a phrase; an unterminated quote runs to the end of the query.
+    """
+    words, phrases, excluded = [], [], []
+    prefix = False
+    for match in QUERY_RE.finditer(query):
+        sign, quoted, bare = match.groups()
+        terms = tokenize(quoted if quoted is not None else bare)
+        prefix = False
+        if not terms:
+            continue
+        if sign:
+            excluded.append(terms)
+        elif len(terms) > 1:
+            phrases.append(terms)
+        else:
+            words.extend(terms)
+            prefix = bare is not None
+    return SearchQuery(words, phrases, excluded, prefix)
+
+
+class SearchIndex:
+    """
+    Inverted index over the site pages.
+
+    Each document gets an integer id; postings map a term to the ids of the
+    documents containing it and the word positions of every occurrence in
+    the body text. Title postings hold per-document term frequencies of the
+    title, used to boost relevance.
+    """
+
+    def __init__(self):
+        # Removed documents leave a None slot so that ids stay stable
+        self.documents = DocumentStore()
+        self.doc_ids: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[int, Sequence[int]]] = {}
+        self.title_postings: Dict[str, Dict[int, int]] = {}
+        self.terms: List[str] = []
+        # Body length in words per document id, 0 for removed documents
+        self.doc_lengths = array('I')
+        self.total_length = 0
+        # Stats of every file seen, including empty and unreadable ones
+        self.stats: Dict[str, FileStat] = {}
+        self.generation = 0
+        self._fingerprint: Optional[str] = None
+        self._trigrams: Optional[TrigramIndex] = None
+        self._directories: Optional[Dict[str, List[Tuple[str, int]]]] = None
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the (path, mtime, size) of every indexed file"""
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for path in sorted(self.stats):
+                mtime_ns, size = self.stats[path]
+                digest.update(f"{path}\0{mtime_ns}\0{size}\n".encode('utf-8', 'surrogateescape'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def trigrams(self) -> TrigramIndex:
+        """Trigram index over the vocabulary, built on the first fuzzy query"""
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex(self.terms)
+        return self._trigrams
+
+    @property
+    def directories(self) -> Dict[str, List[Tuple[str, int]]]:
+        """Documents by directory, see group_by_directory(); built on the first filtered query"""
+        if self._directories is None:
+            self._directories = group_by_directory(self.doc_ids.items())
+        return self._directories
+
+    def add_document(self, document: Document) -> int:
+        doc_id = len(self.documents)
+        self.documents.append(document)
+        self.doc_ids[document.path] = doc_id
+        positions = term_positions(document.text)
+        for term, occurrences in positions.items():
+            self.postings.setdefault(term, {})[doc_id] = occurrences
+        for term, count in title_counts(document.title).items():
+            self.title_postings.setdefault(term, {})[doc_id] = count
+        length = sum(len(p) for p in positions.values())
+        self.doc_lengths.append(length)
+        self.total_length += length
+        return doc_id
+
+    def finalize(self) -> "SearchIndex":
+        """Build the sorted vocabulary used for prefix lookups"""
+        self.terms = sorted(self.postings)
+        return self
+
+    def doc_path(self, doc_id: int) -> str:
+        return self.documents.path(doc_id)
+
+    def updated(self, changes: Dict[str, Optional[FileStat]],
+                cache: Optional[LRUCache] = None) -> "SearchIndex":
+        """
+        Return a new index generation with the changed files re-indexed.
+
+        changes maps a path to its new stat (None when the file is gone).
+        Unchanged postings are shared with this generation and only the
+        lists of affected terms are copied, so this generation stays valid
+        for queries that are still running against it.
+        """
+        index = SearchIndex()
+        index.documents = self.documents.copy()
+        index.doc_ids = dict(self.doc_ids)
+        index.postings = dict(self.postings)
+        index.title_postings = dict(self.title_postings)
+        index.doc_lengths = array('I', self.doc_lengths)
+        index.total_length = self.total_length
+        index.stats = dict(self.stats)
+        index.generation = self.generation + 1
+
+        touched: Dict[str, Dict[int, Sequence[int]]] = {}
+        touched_titles: Dict[str, Dict[int, int]] = {}
+
+        def term_postings(term: str) -> Dict[int, Sequence[int]]:
+            if term not in touched:
+                touched[term] = dict(index.postings.get(term, ()))
+            return touched[term]
+
+        def title_term_postings(term: str) -> Dict[int, int]:
+            if term not in touched_titles:
+                touched_titles[term] = dict(index.title_postings.get(term, ()))
+            return touched_titles[term]
+
+        for path, stat in changes.items():
+            doc_id = index.doc_ids.pop(path, None)
+            if doc_id is not None:
+                old = index.documents[doc_id]
+                for term in set(tokenize(old.text)):
+                    term_postings(term).pop(doc_id, None)
+                for term in title_counts(old.title):
+                    title_term_postings(term).pop(doc_id, None)
+                index.total_length -= index.doc_lengths[doc_id]
+                index.doc_lengths[doc_id] = 0
+                index.documents[doc_id] = None
+
+            if stat is None:
+                index.stats.pop(path, None)
+                continue
+            index.stats[path] = stat
+
+            document = load_document(path, stat, cache)
+            if document is not None:
+                doc_id = len(index.documents)
+                index.documents.append(document)
+                index.doc_ids[path] = doc_id
+                positions = term_positions(document.text)
+                for term, occurrences in positions.items():
+                    term_postings(term)[doc_id] = occurrences
+                for term, count in title_counts(document.title).items():
+                    title_term_postings(term)[doc_id] = count
+                length = sum(len(p) for p in positions.values())
+                index.doc_lengths.append(length)
+                index.total_length += length
+
+        for term, docs in touched_titles.items():
+            if docs:
+                index.title_postings[term] = docs
+            else:
+                index.title_postings.pop(term, None)
+
+        added, removed = [], set()
+        for term, docs in touched.items():
+            if docs:
+                if term not in index.postings:
+                    added.append(term)
+                index.postings[term] = docs
+            elif index.postings.pop(term, None) is not None:
+                removed.add(term)
+
+        if added or removed:
+            index.terms = [term for term in heapq.merge(self.terms, sorted(added)) if term not in removed]
+        else:
+            index.terms = self.terms
+
+        # Edited pages leave their old text behind in the shared buffer
+        if index.documents.wasteful:
+            index.documents = index.documents.compacted()
+        return index
+
+    def expand_prefix(self, prefix: str) -> List[str]:
+        """Return all indexed terms starting with prefix"""
+        result = []
+        for i in range(bisect_left(self.terms, prefix), len(self.terms)):
+            if not self.terms[i].startswith(prefix):
+                break
+            result.append(self.terms[i])
+        return result
+
+    def prefix_frequencies(self, prefix: str) -> List[Tuple[str, int]]:
+        """(term, document frequency) of every indexed term starting with prefix"""
+        return [(term, self.doc_frequency(term)) for term in self.expand_prefix(prefix)]
+
+    def term_groups(self, query: str) -> List[List[str]]:
+        """
+        Return the index terms for every required word of query, phrase
+        words first. The last typed word is matched as a prefix so
+        partially typed live-search input still finds documents.
+        """
+        return self.query_groups(parse_query(query))
+
+    def query_groups(self, query: SearchQuery) -> List[List[str]]:
+        groups = [[word] for phrase in query.phrases for word in phrase]
+        groups.extend([word] + query.variants.get(word, []) for word in query.words)
+        if query.prefix:
+            last = query.words[-1]
+            groups[-1] = self.expand_prefix(last) + query.variants.get(last, [])
+        return groups
+
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        """Return query with typo corrections from the vocabulary, see correct_query()"""
+        return correct_query(query, self.terms, lambda: self.trigrams)
+
+    def docs_for_term(self, term: str) -> Set[int]:
+        return set(self.postings.get(term, ()))
+
+    def _group_docs(self, group: List[str]):
+        """Postings of a term, or the ids of documents with any term of a prefix expansion"""
+        if len(group) == 1:
+            return self.postings.get(group[0], {})
+        docs = set()
+        for term in group:
+            docs.update(self.postings.get(term, ()))
+        return docs
+
+    def _match(self, groups: List[List[str]]) -> Set[int]:
+        """
+        Documents containing a term of every group.
+
+        Posting lists are intersected from the shortest to the longest:
+        every candidate left is probed in the next list, so the cost is
+        bounded by the rarest word rather than the size of the corpus.
+        """
+        if not groups:
+            return set()
+        lists = sorted((self._group_docs(group) for group in groups), key=len)
+        result = set(lists[0])
+        for docs in lists[1:]:
+            if not result:
+                break
+            result = {doc_id for doc_id in result if doc_id in docs}
+        return result
+
+    def _with_phrase(self, phrase: List[str], docs: Set[int]) -> Set[int]:
+        """The documents of docs whose body contains the words of phrase in sequence"""
+        lists = sorted((self.postings.get(word, {}) for word in phrase), key=len)
+        docs = {doc_id for doc_id in docs if all(doc_id in postings for postings in lists)}
+        if len(phrase) == 1 or not docs:
+            return docs
+        word_postings = [self.postings[word] for word in phrase]
+        return {doc_id for doc_id in docs
+                if has_sequence([postings[doc_id] for postings in word_postings])}
+
+    def match(self, query: SearchQuery, allowed: Optional[Set[int]] = None) -> Set[int]:
+        """
+        Documents with every word and phrase of query and none of its
+        exclusions; only those in allowed when it is given
+        """
+        docs = self._match(self.query_groups(query))
+        if allowed is not None:
+            docs &= allowed
+        for phrase in query.phrases:
+            if not docs:
+                break
+            docs = self._with_phrase(phrase, docs)
+        for phrase in query.excluded:
+            if not docs:
+                break
+            docs -= self._with_phrase(phrase, docs)
+        return docs
+
+    def candidates(self, query: str) -> List[int]:
+        """Return ids of documents that match query, see parse_query()"""
+        return sorted(self.match(parse_query(query)))
+
+    def doc_frequency(self, term: str) -> int:
+        """Number of documents whose body contains term"""
+        return len(self.postings.get(term, ()))
+
+    def complete(self, query: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """
+        Return the most common completions of the last word of query.
+
+        Completions are ranked by the number of documents containing them
+        together with all the preceding words; with a single word that is
+        simply its document frequency.
+        """
+        words = tokenize(query)
+        if not words or limit <= 0:
+            return []
+        counted = self.prefix_frequencies(words[-1])
+        if len(words) > 1:
+            docs = self._match([[word] for word in words[:-1]])
+            counted = [(term, len(docs.intersection(self.postings.get(term, ())))) for term, _ in counted] \
+                if docs else ()
+        return [(term, count) for term, count in heapq.nlargest(limit, counted, key=lambda item: item[1])
+                if count > 0]
+
+    def rank(self, query: str) -> "Ranking":
+        """Score the candidates of query, see rank_groups()"""
+        return self.rank_query(parse_query(query))
+
+    def rank_query(self, query: SearchQuery, allowed: Optional[Set[int]] = None,
+                   candidates: Optional[int] = None) -> "Ranking":
+        """
+        Score the documents matching query; with candidates, only that
+        many of them, see cap_candidates()
+        """
+        groups = self.query_groups(query)
+        docs = self.match(query, allowed)
+        if candidates is not None and len(docs) > candidates:
+            docs = self.cap_candidates(docs, groups, candidates)
+        return self.rank_groups(groups, docs, query.phrases)
+
+    def cap_candidates(self, docs: Set[int], groups: List[List[str]], cap: int) -> Set[int]:
+        """
+        At most cap of docs, e.g. for typeahead: the ones with a term of
+        groups in their title first, then the lowest ids
+        """
+        chosen: Set[int] = set()
+        for group in groups:
+            for term in group:
+                for doc_id in self.title_postings.get(term, ()):
+                    if doc_id in docs:
+                        chosen.add(doc_id)
+                        if len(chosen) >= cap:
+                            return chosen
+        chosen.update(heapq.nsmallest(cap - len(chosen), (doc_id for doc_id in docs if doc_id not in chosen)))
+        return chosen
+
+    def rank_groups(self, groups: List[List[str]], docs: Optional[Set[int]] = None,
+                    phrases: Sequence[List[str]] = ()) -> "Ranking":
+        """
+        Score the documents containing a term of every group (or the given
+        docs) with BM25 over body and title.
+
+        Body frequencies are normalized by document length, title
+        frequencies are weighted by TITLE_BOOST, and the sum of both is
+        saturated as in plain BM25. Next to the score every candidate gets
+        its number of matches: the body occurrences of all query terms.
+        The first groups may hold the words of phrases, as query_groups()
+        puts them; those count as matches only where the whole phrase
+        occurs.
+        """
+        if docs is None:
+            docs = self._match(groups)
+        if not docs:
+            return Ranking({})
+
+        count = len(self)
+        average_length = self.total_length / count or 1
+        scores = dict.fromkeys(docs, 0.0)
+        matches = dict.fromkeys(docs, 0)
+        phrase_words = sum(len(phrase) for phrase in phrases)
+
+        for phrase in phrases:
+            word_postings = [self.postings.get(word, {}) for word in phrase]
+            for doc_id in docs:
+                if all(doc_id in postings for postings in word_postings):
+                    matches[doc_id] += count_sequences([postings[doc_id] for postings in word_postings])
+
+        for number, group in enumerate(groups):
+            counted = number >= phrase_words
+            for term in group:
+                body = self.postings.get(term, {})
+                title = self.title_postings.get(term, {})
+                df = len(body) + sum(1 for doc_id in title if doc_id not in body)
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+                frequencies: Dict[int, float] = {}
+                for doc_id, positions in candidate_postings(body, scores):
+                    if counted:
+                        matches[doc_id] += len(positions)
+                    norm = 1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length
+                    frequencies[doc_id] = len(positions) / norm
+                for doc_id, title_count in candidate_postings(title, scores):
+                    frequencies[doc_id] = frequencies.get(doc_id, 0.0) + TITLE_BOOST * title_count
+
+                for doc_id, frequency in frequencies.items():
+                    scores[doc_id] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1)
+
+        return Ranking({doc_id: (score, matches[doc_id]) for doc_id, score in scores.items()})
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+
+class Ranking:
+    """
+    Candidates of a query in relevance order.
+
+    Documents are popped from a heap one at a time, so taking the best k of
+    n candidates costs O(n + k log n) instead of a full sort.
+    """
+
+    def __init__(self, scores: Dict[int, Tuple[float, int]]):
+        self.scores = scores
+        # Ties are broken by document id to keep the order stable
+        self._heap = [(-score, doc_id) for doc_id, (score, _) in scores.items()]
+        heapq.heapify(self._heap)
+
+    def __iter__(self) -> Iterator[int]:
+        while self._heap:
+            yield heapq.heappop(self._heap)[1]
+
+    def remaining(self) -> List[int]:
+        """Candidates not taken yet, in no particular order"""
+        return [doc_id for _, doc_id in self._heap]
+
+    def key(self, doc_id: int) -> Tuple[float, int]:
+        """Position of a document in the order, usable with skip_past()"""
+        return self.scores[doc_id][0], doc_id
+
+    def skip_past(self, score: float, doc_id: int) -> List[int]:
+        """
+        Drop the candidates ordered up to and including (score, doc_id),
+        e.g. the ones on previous pages, and return their ids
+        """
+        position = (-score, doc_id)
+        skipped = [entry[1] for entry in self._heap if entry <= position]
+        if skipped:
+            self._heap = [entry for entry in self._heap if entry > position]
+            heapq.heapify(self._heap)
+        return skipped
+
+    def matches(self, doc_id: int) -> int:
+        """Number of query term occurrences in the document body, from the index"""
+        return self.scores[doc_id][1]
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+
+def candidate_postings(postings, docs) -> Iterator[Tuple[int, Any]]:
+    """The (doc_id, value) pairs of postings for the documents in docs, walking the smaller of both"""
+    if len(docs) < len(postings):
+        return ((doc_id, postings[doc_id]) for doc_id in docs if doc_id in postings)
+    return ((doc_id, value) for doc_id, value in postings.items() if doc_id in docs)
+
+
+def term_positions(text: str) -> Dict[str, Sequence[int]]:
+    """Map every term of text to the word positions it occurs at"""
+    positions: Dict[str, Sequence[int]] = {}
+    for position, term in enumerate(tokenize(text)):
+        if term not in positions:
+            positions[term] = array('I')
+        positions[term].append(position)
+    return positions
+
+
+def sequence_starts(positions: List[Sequence[int]]) -> Iterator[int]:
+    """
+    Yield every p for which the sorted position lists contain p, p + 1, ...,
+    i.e. where the words they belong to occur next to each other in order.
+    Candidates come from the word with the fewest occurrences.
+    """
+    anchor = min(range(len(positions)), key=lambda i: len(positions[i]))
+    for position in positions[anchor]:
+        start = position - anchor
+        if start < 0:
+            continue
+        for i, occurrences in enumerate(positions):
+            if i == anchor:
+                continue
+            j = bisect_left(occurrences, start + i)
+            if j == len(occurrences) or occurrences[j] != start + i:
+                break
+        else:
+            yield start
+
+
+def has_sequence(positions: List[Sequence[int]]) -> bool:
+    """Whether the words of the position lists occur in sequence, see sequence_starts()"""
+    return next(sequence_starts(positions), None) is not None
+
+
+def count_sequences(positions: List[Sequence[int]]) -> int:
+    """Number of places the words of the position lists occur in sequence"""
+    return sum(1 for _ in sequence_starts(positions))
+
+
+def title_counts(title: str) -> Dict[str, int]:
+    """Map every term of a title to its number of occurrences"""
+    counts: Dict[str, int] = {}
+    for term in tokenize(title):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def build_index(files: Iterable[str], cache: Optional[LRUCache] = None) -> SearchIndex:
+    """Parse every file and build an inverted index over them"""
+    index = SearchIndex()
+    for file_path in files:
+        stat = file_stat(file_path)
+        if stat is None:
+            continue
+        index.stats[file_path] = stat
+        document = load_document(file_path, stat, cache)
+        if document is not None:
+            index.add_document(document)
+    return index.finalize()
+
+
+def merge_indexes(parts: Iterable[SearchIndex]) -> SearchIndex:
+    """Merge partial indexes built over disjoint file lists into one"""
+    index = SearchIndex()
+    for part in parts:
+        offset = len(index.documents)
+        index.documents.extend(part.documents)
+        index.doc_ids.update((path, doc_id + offset) for path, doc_id in part.doc_ids.items())
+        index.doc_lengths.extend(part.doc_lengths)
+        index.total_length += part.total_length
+        index.stats.update(part.stats)
+        for term, docs in part.postings.items():
+            target = index.postings.setdefault(term, {})
+            for doc_id, positions in docs.items():
+                target[doc_id + offset] = positions
+        for term, docs in part.title_postings.items():
+            target = index.title_postings.setdefault(term, {})
+            for doc_id, count in docs.items():
+                target[doc_id + offset] = count
+    return index.finalize()
+
+
+def build_index_parallel(files: Iterable[str], workers: int = 0,
+                         cache: Optional[LRUCache] = None) -> SearchIndex:
+    """
+    Build the index with one process per CPU core (or the given number of
+    workers). The file list is split into contiguous shards, each worker
+    indexes its shard and the partial indexes are merged in order, so
+    document ids match a sequential build.
+    """
+    files = list(files)
+    workers = min(workers or os.cpu_count() or 1, len(files) // PARALLEL_MIN_FILES or 1)
+    if workers <= 1:
+        return build_index(files, cache)
+
+    shard_size = -(-len(files) // workers)
+    shards = [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+    # spawn rather than fork: the server process runs other threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        index = merge_indexes(pool.map(build_index, shards))
+
+    if cache is not None:
+        for document in index.documents:
+            cache.put((document.path,) + index.stats[document.path], document)
+    return index
@@ -0,0 +1,338 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from search_cache import LRUCache
+from search_index import FileStat, SearchIndex, build_index_parallel, file_stat
+from search_snapshot import MappedIndex, open_snapshot, write_snapshot
+
+# watchfiles (installed with uvicorn[standard]) gives us inotify-based watching
+try:
+    from watchfiles import watch
+except ImportError:
+    watch = None
+
+# File locks elect the worker that maintains a shared index; not on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class IndexRefresher:
+    """
+    Keeps the search index in sync with the files on disk.
+
+    Only files whose mtime or size changed are re-parsed. Changes are picked
+    up from inotify events through watchfiles when it is available, and by a
+    periodic stat sweep otherwise. Each refresh publishes a new index
+    generation with a single assignment, so a query always works with one
+    consistent generation. on_publish, when given, is called after every
+    new generation, e.g. to tell other workers about it.
+    """
+
+    def __init__(self, list_files: Callable[[], List[str]], search_dir: str,
+                 extensions: List[str], interval: float = 30, use_watcher: bool = True,
+                 document_cache: Optional[LRUCache] = None, workers: int = 0,
+                 snapshot_path: Optional[str] = None,
+                 on_publish: Optional[Callable[[SearchIndex], None]] = None):
+        self.list_files = list_files
+        self.search_dir = search_dir
+        self.extensions = extensions
+        self.interval = interval
+        self.use_watcher = use_watcher
+        self.document_cache = document_cache
+        self.workers = workers
+        self.snapshot_path = snapshot_path
+        self.on_publish = on_publish
+        self.index: Optional[SearchIndex] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_index(self) -> SearchIndex:
+        """Return the current index generation, building it on first use"""
+        if self.index is None:
+            with self._lock:
+                if self.index is None:
+                    self.index = self._load_or_build()
+        return self.index
+
+    def _load_or_build(self) -> SearchIndex:
+        """
+        Start from the index snapshot when there is one, re-indexing only the
+        files changed since it was written; build from scratch and write a
+        snapshot otherwise.
+        """
+        files = self.list_files()
+        index = open_snapshot(self.snapshot_path) if self.snapshot_path else None
+        if index is not None:
+            changes = self._changed(index, set(files) | set(index.stats))
+            logger.info(f"Mapped search index snapshot {self.snapshot_path}, {len(changes)} files changed since")
+            return index.updated(changes, self.document_cache) if changes else index
+
+        logger.info(f"Building search index over {len(files)} files")
+        index = build_index_parallel(files, self.workers, self.document_cache)
+        self._save(index)
+        return index
+
+    def _save(self, index: SearchIndex):
+        """Write a snapshot for the next start, if a snapshot path is configured"""
+        if not self.snapshot_path:
+            return
+        try:
+            write_snapshot(index, self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"Could not write search index snapshot {self.snapshot_path}: {str(e)}")
+
+    @staticmethod
+    def _changed(index: SearchIndex, paths: Iterable[str]) -> Dict[str, Optional[FileStat]]:
+        """Map every path whose stat differs from the index to its new stat"""
+        changes = {}
+        for path in paths:
+            stat = file_stat(path)
+            if stat != index.stats.get(path):
+                changes[path] = stat
+        return changes
+
+    def rebuild(self) -> SearchIndex:
+        """
+        Build a fresh generation from scratch, dropping the slots of removed
+        documents. Unchanged pages come from the document cache.
+        """
+        with self._lock:
+            index = build_index_parallel(self.list_files(), self.workers, self.document_cache)
+            if self.index is not None:
+                index.generation = self.index.generation + 1
+            self.index = index
+            self._save(index)
+        self._published(index)
+        return index
+
+    def refresh(self, paths: Optional[Iterable[str]] = None) -> SearchIndex:
+        """
+        Re-index files whose stat changed.
+
+        Only the given paths are checked; without paths every file under the
+        search directory is swept, which also picks up new and deleted files.
+        """
+        self.get_index()
+        with self._lock:
+            index = self.index
+            if paths is None:
+                paths = set(self.list_files()) | set(index.stats)
+
+            changes = self._changed(index, paths)
+            if not changes:
+                return index
+            index = self.index = index.updated(changes, self.document_cache)
+            logger.info(f"Search index generation {index.generation}: re-indexed {len(changes)} files")
+        self._published(index)
+        return index
+
+    def _published(self, index: SearchIndex):
+        if self.on_publish is not None:
+            try:
+                self.on_publish(index)
+            except Exception as e:
+                logger.error(f"Error announcing search index generation {index.generation}: {str(e)}")
+
+    def start(self):
+        """Start watching the search directory in a background thread"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="search-index-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        self.get_index()
+        if watch is not None and self.use_watcher:
+            try:
+                for changes in watch(self.search_dir, watch_filter=self._watch_filter,
+                                     debounce=200, stop_event=self._stop):
+                    self.refresh({self._index_path(path) for _, path in changes})
+                return
+            except Exception as e:
+                logger.warning(f"File watcher unavailable, falling back to stat sweeps: {str(e)}")
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing search index: {str(e)}")
+
+    def _watch_filter(self, change, path: str) -> bool:
+        return Path(path).suffix.lstrip('.') in self.extensions
+
+    def _index_path(self, path: str) -> str:
+        """Convert a path reported by the watcher to the form used by list_files"""
+        relative = os.path.relpath(path, os.path.abspath(self.search_dir))
+        return str(Path(self.search_dir) / relative)
+
+
+class SharedIndexRefresher(IndexRefresher):
+    """
+    IndexRefresher for worker processes sharing one index snapshot.
+
+    The process holding the lock file next to the snapshot is the leader:
+    it builds and refreshes the index like IndexRefresher and writes new
+    generations to the snapshot. The other processes are followers: they
+    never index pages themselves, but map the snapshot read-only and switch
+    to the new one whenever the leader replaces it, so the index is held in
+    memory once, plus page cache shared by all followers, however many
+    workers there are. When the leader exits, its lock is released and the
+    first follower to notice takes over.
+
+    Writing a snapshot serializes the whole index, so the leader does not
+    write one per page edit: the first new generation schedules a write
+    save_delay seconds later, in the background, of whatever generation is
+    current by then. The generation is announced (on_publish) once it is
+    written, so followers can find it.
+    """
+
+    def __init__(self, *args, follow_interval: float = 1, wait_timeout: float = 60, save_delay: float = 5,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.follow_interval = follow_interval
+        self.wait_timeout = wait_timeout
+        self.save_delay = save_delay
+        self.leader = False
+        self._lock_file = None
+        self._save_lock = threading.Lock()
+        self._saved_generation: Optional[int] = None
+        self._save_timer: Optional[threading.Timer] = None
+        # (inode, mtime_ns, size) of the snapshot a follower maps
+        self._snapshot_id: Optional[Tuple[int, int, int]] = None
+
+    def _try_lead(self) -> bool:
+        """Become the leader if no other process is"""
+        if self.leader:
+            return True
+        if fcntl is None:
+            # Without file locks every process maintains its own index
+            self.leader = True
+            return True
+        lock_file = open(f"{self.snapshot_path}.lock", "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.leader = True
+        logger.info(f"Process {os.getpid()} maintains the shared search index {self.snapshot_path}")
+        return True
+
+    def _load_or_build(self) -> SearchIndex:
+        if self._try_lead():
+            index = super()._load_or_build()
+            if not isinstance(index, MappedIndex) or index.overlaid:
+                self._save(index)
+            return index
+        index = self._attach(self.wait_timeout)
+        if index is None:
+            logger.warning(f"No shared search index at {self.snapshot_path} after {self.wait_timeout}s, "
+                           f"building a private one")
+            index = build_index_parallel(self.list_files(), self.workers, self.document_cache)
+        return index
+
+    def _save(self, index: SearchIndex):
+        """Write the snapshot once per generation; followers never write"""
+        if not self.leader:
+            return
+        with self._save_lock:
+            if self._saved_generation is not None and index.generation <= self._saved_generation:
+                return
+            super()._save(index)
+            self._saved_generation = index.generation
+
+    def _published(self, index: SearchIndex):
+        if not self.leader:
+            super()._published(index)
+            return
+        with self._save_lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self):
+        """Write the current generation now if it has not been, and announce it"""
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+        index = self.index
+        if index is None or not self.leader:
+            return
+        if self._saved_generation is not None and index.generation <= self._saved_generation:
+            return
+        # Followers must find the new generation before it is announced
+        self._save(index)
+        super()._published(index)
+
+    def _snapshot_stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.snapshot_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _attach(self, timeout: float = 0) -> Optional[SearchIndex]:
+        """
+        Map the snapshot if it was replaced since the last attach, waiting up
+        to timeout seconds for one to appear; None if there is no new one
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot_id = self._snapshot_stat()
+            if snapshot_id is not None and snapshot_id != self._snapshot_id:
+                index = open_snapshot(self.snapshot_path)
+                if index is not None:
+                    self._snapshot_id = snapshot_id
+                    return index
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.1)
+
+    def refresh(self, paths: Optional[Iterable[str]] = None) -> SearchIndex:
+        """Re-index changed files as the leader, switch to the latest snapshot as a follower"""
+        self.get_index()
+        if self._try_lead():
+            return super().refresh(paths)
+        index = self._attach()
+        if index is not None:
+            with self._lock:
+                self.index = index
+            logger.info(f"Switched to shared search index generation {index.generation}")
+        return self.index
+
+    def stop(self):
+        super().stop()
+        self.flush()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self.leader = False
+
+    def _run(self):
+        self.get_index()
+        while not self.leader:
+            if self._stop.wait(self.follow_interval):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error following shared search index: {str(e)}")
+        super()._run()
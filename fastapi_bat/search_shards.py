@@ -0,0 +1,173 @@
+"""
+Several site roots searched as one.
+
+Every root is a shard with its own refresher and index (or database). A
+query goes at once to every shard with a directory its filter can match,
+and the hits of the shards, each already in relevance order, are merged
+into one order. Scores of different shards are only roughly comparable,
+as each shard weighs terms by its own document frequencies.
+
+Document ids of different shards overlap, so merged hits are keyed by
+doc_id * number of shards + shard; cursors keep their (score, id) form.
+"""
+import hashlib
+import heapq
+from concurrent.futures import Executor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from search_backend import HitKey, PathFilter, SearchHit, SearchHits, SearchView, as_view
+from search_index import SearchQuery
+from search_refresh import IndexRefresher
+
+
+class ShardedHits(SearchHits):
+    """Hits of every shard merged by relevance"""
+
+    def __init__(self, view: "ShardedView", query: SearchQuery, filter_pattern: str,
+                 live_search: Optional[str], cursor: Optional[HitKey], candidates: Optional[int] = None):
+        self.view = view
+        path_filter = PathFilter(filter_pattern)
+        shards = len(view.shards)
+        jobs = []
+        for number, shard in enumerate(view.shards):
+            if not path_filter.allows(shard.directories):
+                continue
+            # A merged hit comes after the cursor iff its shard-local id does
+            shard_cursor = (cursor[0], (cursor[1] - number) // shards) if cursor else None
+            jobs.append((number, shard, shard_cursor))
+
+        def run(job) -> SearchHits:
+            _, shard, shard_cursor = job
+            return shard.hits(query, filter_pattern, live_search, shard_cursor, candidates)
+
+        if view.executor is not None and len(jobs) > 1:
+            results = list(view.executor.map(run, jobs))
+        else:
+            results = [run(job) for job in jobs]
+        self.shard_hits = [(number, hits) for (number, _, _), hits in zip(jobs, results)]
+        # Next hit of every shard not yielded yet: (order, shard, hit, iterator)
+        self._heap: List[Tuple[Tuple[float, int], int, SearchHit, Iterator[SearchHit]]] = []
+
+    def _push(self, number: int, hits: Iterator[SearchHit]):
+        hit = next(hits, None)
+        if hit is None:
+            return
+        hit.key = (hit.key[0], hit.key[1] * len(self.view.shards) + number)
+        heapq.heappush(self._heap, (self.view.order(hit.key), number, hit, hits))
+
+    def __iter__(self) -> Iterator[SearchHit]:
+        for number, hits in self.shard_hits:
+            self._push(number, iter(hits))
+        while self._heap:
+            _, number, hit, hits = heapq.heappop(self._heap)
+            yield hit
+            self._push(number, hits)
+
+    def unseen(self) -> Tuple[int, int, bool]:
+        # Hits taken from a shard for merging but never yielded
+        count = len(self._heap)
+        matches = sum(entry[2].count for entry in self._heap)
+        more = count > 0
+        for _, hits in self.shard_hits:
+            shard_count, shard_matches, shard_more = hits.unseen()
+            count += shard_count
+            matches += shard_matches
+            more = more or shard_more
+        return count, matches, more
+
+
+class ShardedView(SearchView):
+    """
+    The current views of all shards. With an executor, shards are
+    searched concurrently in it; it must not be the pool running the
+    queries themselves.
+    """
+
+    def __init__(self, roots: List[str], shards: List[SearchView], executor: Optional[Executor] = None):
+        self.roots = roots
+        self.shards = shards
+        self.executor = executor
+
+    @property
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1()
+        for root, shard in zip(self.roots, self.shards):
+            digest.update(f"{root}\0{shard.fingerprint}\n".encode('utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+
+    def hits(self, query: SearchQuery, filter_pattern: str, live_search: Optional[str],
+             cursor: Optional[HitKey] = None, candidates: Optional[int] = None) -> SearchHits:
+        return ShardedHits(self, query, filter_pattern, live_search, cursor, candidates)
+
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        """The query with the corrections found in any shard"""
+        variants: Dict[str, List[str]] = {}
+        for shard in self.shards:
+            for word, words in shard.fuzzy_query(query).variants.items():
+                merged = variants.setdefault(word, [])
+                merged.extend(variant for variant in words if variant not in merged)
+        return SearchQuery(query.words, query.phrases, query.excluded, query.prefix, variants)
+
+    def complete(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """Completions of every shard, their document frequencies summed"""
+        counts: Dict[str, int] = {}
+        for shard in self.shards:
+            for term, count in shard.complete(query, limit):
+                counts[term] = counts.get(term, 0) + count
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    @property
+    def directories(self) -> Dict[str, List[Tuple[str, int]]]:
+        shards = len(self.shards)
+        directories: Dict[str, List[Tuple[str, int]]] = {}
+        for number, shard in enumerate(self.shards):
+            for directory, files in shard.directories.items():
+                directories.setdefault(directory, []).extend(
+                    (name, doc_id * shards + number) for name, doc_id in files)
+        return directories
+
+    def order(self, key: HitKey) -> Tuple[float, int]:
+        return self.shards[0].order(key) if self.shards else key
+
+    def describe(self) -> Dict[str, Any]:
+        shards = [shard.describe() for shard in self.shards]
+        return {"backend": shards[0]["backend"] if shards else None,
+                "generation": sum(shard["generation"] for shard in shards),
+                "documents": sum(shard["documents"] for shard in shards),
+                "terms": sum(shard["terms"] for shard in shards),
+                "shards": dict(zip(self.roots, shards))}
+
+
+class ShardedRefresher:
+    """
+    One refresher per site root, offering the IndexRefresher interface the
+    search module uses. get_index() returns a ShardedView of the current
+    generations of all shards.
+    """
+
+    def __init__(self, roots: List[str], refreshers: List[IndexRefresher], executor: Optional[Executor] = None):
+        self.roots = roots
+        self.refreshers = refreshers
+        self.executor = executor
+
+    def get_index(self) -> ShardedView:
+        return ShardedView(self.roots, [as_view(refresher.get_index()) for refresher in self.refreshers],
+                           self.executor)
+
+    def refresh(self) -> ShardedView:
+        """Sweep every root for changed files"""
+        for refresher in self.refreshers:
+            refresher.refresh()
+        return self.get_index()
+
+    def rebuild(self) -> ShardedView:
+        for refresher in self.refreshers:
+            refresher.rebuild()
+        return self.get_index()
+
+    def start(self):
+        for refresher in self.refreshers:
+            refresher.start()
+
+    def stop(self):
+        for refresher in self.refreshers:
+            refresher.stop()
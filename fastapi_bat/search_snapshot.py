@@ -0,0 +1,667 @@
+"""
+Binary snapshot of the search index, memory-mapped at startup.
+
+Layout (native byte order, every section padded to 8 bytes):
+
+    header          magic, version, counts, generation, fingerprint, section offsets
+    strings         UTF-8 blob with paths, titles, texts, meta tags (JSON) and terms
+    files           per file:     path offset, path length, mtime_ns, size, doc id + 1
+    documents       per document: offset/length pairs of path, title, text and meta
+    terms           per term, sorted: term offset, term length, postings offset, doc count
+    postings        per term: doc ids (n), then n + 1 starts into the positions array
+    positions       word positions of every term occurrence
+    title terms     like terms, for the words of page titles
+    title postings  per title term: doc ids (n), then their frequencies (n)
+    lengths         body length in words per document
+
+Tables are uint64 arrays, the other sections are uint32 arrays. They
+are read in place through memoryviews of the mapping, so opening a snapshot
+costs a few page faults rather than a parse, and workers that map the same
+file share its pages through the page cache. Pages changed after the
+snapshot was written live in a layer on top of it (see MappedIndex).
+"""
+import copy
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from search_cache import LRUCache
+from search_index import (
+    Document, DocumentStore, FileStat, SearchIndex, SearchQuery, TrigramIndex, correct_query, load_document,
+    term_positions, title_counts, tokenize
+)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BATIDX\0\0"
+VERSION = 2
+# magic, version, little endian flag, documents, files, terms, title terms,
+# generation, total length, fingerprint, then offsets of the sections in
+# layout order and of the end of the file
+HEADER = struct.Struct("<8sIIQQQQQQ40s10Q")
+
+FILE_FIELDS = 5
+DOCUMENT_FIELDS = 8
+TERM_FIELDS = 4
+
+
+class _Writer:
+    """Accumulates the sections of a snapshot"""
+
+    def __init__(self):
+        self.strings = bytearray()
+        self.files = array('Q')
+        self.documents = array('Q')
+        self.terms = array('Q')
+        self.postings = array('I')
+        self.positions = array('I')
+        self.title_terms = array('Q')
+        self.title_postings = array('I')
+        self.lengths = array('I')
+
+    def add_string(self, value: str) -> Tuple[int, int]:
+        data = value.encode('utf-8', 'surrogatepass')
+        offset = len(self.strings)
+        self.strings += data
+        return offset, len(data)
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 8)
+
+
+def write_snapshot(index: SearchIndex, path: str):
+    """
+    Write index to path. The file is replaced atomically, so processes that
+    still map the previous snapshot keep a consistent view of it.
+    """
+    writer = _Writer()
+
+    # Document ids are compacted: removed documents leave no gaps on disk
+    new_ids: Dict[int, int] = {}
+    for doc_id, document in enumerate(index.documents):
+        if document is None:
+            continue
+        new_ids[doc_id] = len(new_ids)
+        writer.lengths.append(index.doc_lengths[doc_id])
+        fields = []
+        for value in (document.path, document.title, document.text, json.dumps(document.meta)):
+            fields.extend(writer.add_string(value))
+        writer.documents.extend(fields)
+
+    for file_path in sorted(index.stats):
+        mtime_ns, size = index.stats[file_path]
+        doc_id = index.doc_ids.get(file_path)
+        writer.files.extend(writer.add_string(file_path))
+        writer.files.extend((mtime_ns, size, 0 if doc_id is None else new_ids[doc_id] + 1))
+
+    for term in index.terms:
+        docs = sorted((new_ids[doc_id], positions) for doc_id, positions in index.postings[term].items())
+        writer.terms.extend(writer.add_string(term))
+        writer.terms.extend((len(writer.postings), len(docs)))
+        writer.postings.extend(doc_id for doc_id, _ in docs)
+        start = len(writer.positions)
+        for _, positions in docs:
+            writer.postings.append(start)
+            writer.positions.extend(positions)
+            start += len(positions)
+        writer.postings.append(start)
+
+    title_terms = sorted(index.title_postings)
+    for term in title_terms:
+        docs = sorted((new_ids[doc_id], count) for doc_id, count in index.title_postings[term].items())
+        writer.title_terms.extend(writer.add_string(term))
+        writer.title_terms.extend((len(writer.title_postings), len(docs)))
+        writer.title_postings.extend(doc_id for doc_id, _ in docs)
+        writer.title_postings.extend(count for _, count in docs)
+
+    sections = [_pad(bytes(writer.strings))] + [
+        _pad(table.tobytes())
+        for table in (writer.files, writer.documents, writer.terms, writer.postings, writer.positions,
+                      writer.title_terms, writer.title_postings, writer.lengths)
+    ]
+    offsets = []
+    offset = HEADER.size + (-HEADER.size % 8)
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    offsets.append(offset)
+
+    header = HEADER.pack(
+        MAGIC, VERSION, sys.byteorder == "little",
+        len(new_ids), len(index.stats), len(index.terms), len(title_terms),
+        index.generation, index.total_length, index.fingerprint.encode('ascii'), *offsets
+    )
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_pad(header))
+        for section in sections:
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+class _Table:
+    """Read-only view of fixed-width uint64 records"""
+
+    def __init__(self, view: memoryview, fields: int):
+        self.view = view
+        self.fields = fields
+
+    def __len__(self) -> int:
+        return len(self.view) // self.fields
+
+    def record(self, i: int) -> memoryview:
+        return self.view[i * self.fields:(i + 1) * self.fields]
+
+
+class _Terms:
+    """Sorted vocabulary decoded on access; supports bisect and iteration"""
+
+    def __init__(self, strings: memoryview, table: _Table):
+        self.strings = strings
+        self.table = table
+        # Bisecting decodes a term per probe, so this path is kept short
+        self._view = table.view
+        self._count = len(table)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        offset = self._view[i * TERM_FIELDS]
+        return str(self.strings[offset:offset + self._view[i * TERM_FIELDS + 1]], 'utf-8', 'surrogatepass')
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._count):
+            yield self[i]
+
+    def doc_count(self, i: int) -> int:
+        """Number of documents containing the i-th term"""
+        return self._view[i * TERM_FIELDS + 3]
+
+    def prefixed(self, prefix: str) -> Iterator[Tuple[int, str]]:
+        """(index, term) of the terms starting with prefix, in order"""
+        for i in range(bisect_left(self, prefix), self._count):
+            term = self[i]
+            if not term.startswith(prefix):
+                break
+            yield i, term
+
+
+class _PostingList(Mapping):
+    """
+    doc_id -> positions (or title frequency) of one term, read from the
+    mapping on access. Doc ids are sorted, so lookups bisect them.
+    """
+
+    __slots__ = ('doc_ids', 'starts', 'values')
+
+    def __init__(self, doc_ids: memoryview, starts: Optional[memoryview], values: memoryview):
+        self.doc_ids = doc_ids
+        # Body postings: n + 1 starts into the positions in values;
+        # title postings: None, values holds the frequencies
+        self.starts = starts
+        self.values = values
+
+    def _find(self, doc_id: int) -> int:
+        k = bisect_left(self.doc_ids, doc_id)
+        return k if k < len(self.doc_ids) and self.doc_ids[k] == doc_id else -1
+
+    def __getitem__(self, doc_id: int) -> Any:
+        k = self._find(doc_id)
+        if k < 0:
+            raise KeyError(doc_id)
+        if self.starts is None:
+            return self.values[k]
+        return self.values[self.starts[k]:self.starts[k + 1]]
+
+    def __contains__(self, doc_id) -> bool:
+        return self._find(doc_id) >= 0
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.doc_ids)
+
+    def items(self) -> Iterator[Tuple[int, Any]]:
+        if self.starts is None:
+            return zip(self.doc_ids, self.values)
+        values = self.values
+        return ((doc_id, values[start:end]) for doc_id, start, end in zip(self.doc_ids, self.starts, self.starts[1:]))
+
+
+class _Postings:
+    """term -> _PostingList read straight from the mapping"""
+
+    def __init__(self, terms: _Terms, postings: memoryview, positions: Optional[memoryview] = None):
+        self.terms = terms
+        self.postings = postings
+        self.positions = positions
+
+    def _find(self, term: str) -> int:
+        i = bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else -1
+
+    def _docs(self, i: int) -> _PostingList:
+        _, _, offset, count = self.terms.table.record(i)
+        doc_ids = self.postings[offset:offset + count]
+        if self.positions is None:
+            # Title postings store frequencies right after the doc ids
+            return _PostingList(doc_ids, None, self.postings[offset + count:offset + 2 * count])
+        return _PostingList(doc_ids, self.postings[offset + count:offset + 2 * count + 1], self.positions)
+
+    def count(self, term: str) -> int:
+        """Number of documents containing term, from the term table"""
+        i = self._find(term)
+        return self.terms.doc_count(i) if i >= 0 else 0
+
+    def __contains__(self, term: str) -> bool:
+        return self._find(term) >= 0
+
+    def __getitem__(self, term: str) -> _PostingList:
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._docs(i)
+
+    def get(self, term: str, default=None):
+        i = self._find(term)
+        return self._docs(i) if i >= 0 else default
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.terms)
+
+    def items(self) -> Iterator[Tuple[str, _PostingList]]:
+        for i, term in enumerate(self.terms):
+            yield term, self._docs(i)
+
+
+class _Vocabulary:
+    """Sorted terms of the snapshot without the dead ones, merged with the terms added since"""
+
+    def __init__(self, base: _Terms, extra: List[str], dead: Set[str]):
+        self.base = base
+        self.extra = extra
+        self.dead = dead
+
+    def __len__(self) -> int:
+        return len(self.base) - len(self.dead) + len(self.extra)
+
+    def __iter__(self) -> Iterator[str]:
+        return heapq.merge((term for term in self.base if term not in self.dead), self.extra)
+
+
+
+class _MergedPostingList(Mapping):
+    """Postings of a term in the snapshot without the removed documents, plus those added since"""
+
+    __slots__ = ('base', 'removed', 'added', 'length')
+
+    def __init__(self, base: Optional[_PostingList], removed: Set[int], added: Dict[int, Any], length: int):
+        self.base = base
+        self.removed = removed
+        self.added = added
+        self.length = length
+
+    def __getitem__(self, doc_id: int) -> Any:
+        if doc_id in self.added:
+            return self.added[doc_id]
+        if self.base is None or doc_id in self.removed:
+            raise KeyError(doc_id)
+        return self.base[doc_id]
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self.added or (self.base is not None and doc_id not in self.removed
+                                        and doc_id in self.base)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[int]:
+        if self.base is not None:
+            for doc_id in self.base:
+                if doc_id not in self.removed:
+                    yield doc_id
+        yield from self.added
+
+    def items(self) -> Iterator[Tuple[int, Any]]:
+        if self.base is not None:
+            for doc_id, value in self.base.items():
+                if doc_id not in self.removed:
+                    yield doc_id, value
+        yield from self.added.items()
+
+
+class _Layer:
+    """
+    Postings of the documents changed since the snapshot was written, on
+    top of its _Postings: removed_counts tells how many documents of each
+    term's snapshot postings are tombstoned, added holds the postings of
+    the documents indexed since. Updates copy the outer dicts and only the
+    postings of the terms they touch, like SearchIndex.updated().
+    """
+
+    def __init__(self, base: _Postings, removed: Set[int]):
+        self.base = base
+        self.removed = removed
+        self.removed_counts: Dict[str, int] = {}
+        self.added: Dict[str, Dict[int, Any]] = {}
+        self.vocabulary = _Vocabulary(base.terms, [], set())
+
+    def copy(self, removed: Set[int]) -> "_Layer":
+        layer = _Layer(self.base, removed)
+        layer.removed_counts = dict(self.removed_counts)
+        layer.added = dict(self.added)
+        layer.vocabulary = self.vocabulary
+        return layer
+
+    def get(self, term: str, default=None):
+        i = self.base._find(term)
+        base = self.base._docs(i) if i >= 0 else None
+        dead = self.removed_counts.get(term, 0)
+        added = self.added.get(term)
+        if not dead and not added:
+            return base if base is not None else default
+        length = (len(base) - dead if base is not None else 0) + (len(added) if added else 0)
+        if not length:
+            return default
+        return _MergedPostingList(base, self.removed if dead else set(), added or {}, length)
+
+    def __getitem__(self, term: str):
+        docs = self.get(term)
+        if docs is None:
+            raise KeyError(term)
+        return docs
+
+    def __contains__(self, term: str) -> bool:
+        return self.get(term) is not None
+
+    def __len__(self) -> int:
+        return len(self.vocabulary)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vocabulary)
+
+    def items(self) -> Iterator[Tuple[str, Mapping]]:
+        for term in self.vocabulary:
+            yield term, self[term]
+
+    def prefixed(self, prefix: str) -> List[Tuple[str, int]]:
+        """(term, document frequency) of the live terms starting with prefix, in order"""
+        vocabulary = self.vocabulary
+        base = [(term, vocabulary.base.doc_count(i) - self.removed_counts.get(term, 0)
+                 + len(self.added.get(term, ())))
+                for i, term in vocabulary.base.prefixed(prefix) if term not in vocabulary.dead]
+        extra = []
+        for i in range(bisect_left(vocabulary.extra, prefix), len(vocabulary.extra)):
+            term = vocabulary.extra[i]
+            if not term.startswith(prefix):
+                break
+            extra.append((term, len(self.added[term])))
+        return list(heapq.merge(base, extra))
+
+    def remove(self, doc_id: int, terms: Iterable[str], base_doc: bool, touch: Callable[[str], Dict[int, Any]]):
+        """Drop doc_id from the postings of terms: tombstoned if it is in the snapshot"""
+        for term in terms:
+            if base_doc:
+                self.removed_counts[term] = self.removed_counts.get(term, 0) + 1
+            else:
+                touch(term).pop(doc_id, None)
+
+    def settle(self, touched: Dict[str, Dict[int, Any]], affected: Iterable[str]):
+        """Store the touched postings and bring the vocabulary up to date for the affected terms"""
+        for term, docs in touched.items():
+            if docs:
+                self.added[term] = docs
+            else:
+                self.added.pop(term, None)
+        extra, dead = set(self.vocabulary.extra), set(self.vocabulary.dead)
+        for term in affected:
+            base_count = self.base.count(term)
+            alive = base_count - self.removed_counts.get(term, 0) > 0 or bool(self.added.get(term))
+            if base_count:
+                (dead.discard if alive else dead.add)(term)
+            else:
+                (extra.add if alive else extra.discard)(term)
+        self.vocabulary = _Vocabulary(self.base.terms, sorted(extra), dead)
+
+
+class _Documents:
+    """Document table decoded on access, followed by the documents indexed since"""
+
+    def __init__(self, snapshot: "MappedIndex"):
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.snapshot._documents) + len(self.snapshot._store)
+
+    def __getitem__(self, doc_id: int) -> Optional[Document]:
+        snapshot = self.snapshot
+        base_count = len(snapshot._documents)
+        if doc_id < 0:
+            raise IndexError(doc_id)
+        if doc_id >= base_count:
+            return snapshot._store[doc_id - base_count]
+        if doc_id in snapshot._removed:
+            return None
+        record = snapshot._documents.record(doc_id)
+        string = snapshot._string
+        return Document(
+            string(record[0], record[1]),
+            string(record[2], record[3]),
+            string(record[4], record[5]),
+            json.loads(string(record[6], record[7]))
+        )
+
+    def __iter__(self) -> Iterator[Optional[Document]]:
+        for doc_id in range(len(self)):
+            yield self[doc_id]
+
+
+class MappedIndex(SearchIndex):
+    """
+    A SearchIndex answered directly from a memory-mapped snapshot.
+
+    Only the file table (needed to validate the snapshot against the files
+    on disk) is loaded eagerly. Incremental updates return a new MappedIndex
+    sharing the mapping: pages removed or edited since the snapshot are
+    tombstoned in it, and changed pages are indexed into an in-memory
+    layer on top, so an edit costs about as much as in a SearchIndex.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        if len(buffer) < HEADER.size:
+            raise ValueError("truncated snapshot")
+        (magic, version, little_endian, doc_count, file_count, term_count, title_term_count,
+         generation, total_length, fingerprint, *offsets) = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a search index snapshot")
+        if bool(little_endian) != (sys.byteorder == "little"):
+            raise ValueError("snapshot was written on a machine with a different byte order")
+        if offsets[-1] != len(buffer):
+            raise ValueError("truncated snapshot")
+
+        def section(i: int, code: str, length: int) -> memoryview:
+            itemsize = 8 if code == 'Q' else 4
+            return buffer[offsets[i]:offsets[i] + length * itemsize].cast(code)
+
+        self._strings = buffer[offsets[0]:offsets[1]]
+        files = _Table(section(1, 'Q', file_count * FILE_FIELDS), FILE_FIELDS)
+        self._documents = _Table(section(2, 'Q', doc_count * DOCUMENT_FIELDS), DOCUMENT_FIELDS)
+        terms = _Terms(self._strings, _Table(section(3, 'Q', term_count * TERM_FIELDS), TERM_FIELDS))
+        title_terms = _Terms(self._strings, _Table(section(6, 'Q', title_term_count * TERM_FIELDS), TERM_FIELDS))
+
+        self.path = path
+        self.generation = generation
+        self.total_length = total_length
+        self._fingerprint = fingerprint.decode('ascii')
+        # Documents of the snapshot removed since, and the ones indexed since
+        self._removed: Set[int] = set()
+        self._store = DocumentStore()
+        self._layer: Optional[_Layer] = None
+        self._title_layer: Optional[_Layer] = None
+        self.documents = _Documents(self)
+        self.terms = terms
+        self.postings = _Postings(terms, buffer[offsets[4]:offsets[5]].cast('I'),
+                                  buffer[offsets[5]:offsets[6]].cast('I'))
+        self.title_postings = _Postings(title_terms, buffer[offsets[7]:offsets[8]].cast('I'))
+        self.doc_lengths = section(8, 'I', doc_count)
+        for i in range(len(files)):
+            path_offset, path_length, mtime_ns, size, doc_id = files.record(i)
+            file_path = self._string(path_offset, path_length)
+            self.stats[file_path] = (mtime_ns, size)
+            if doc_id:
+                self.doc_ids[file_path] = doc_id - 1
+
+    def _string(self, offset: int, length: int) -> str:
+        return str(self._strings[offset:offset + length], 'utf-8', 'surrogatepass')
+
+    @property
+    def overlaid(self) -> bool:
+        """Whether pages changed since the snapshot was written"""
+        return self._layer is not None
+
+    def doc_path(self, doc_id: int) -> str:
+        if doc_id >= len(self._documents):
+            return self._store.path(doc_id - len(self._documents))
+        record = self._documents.record(doc_id)
+        return self._string(record[0], record[1])
+
+    def expand_prefix(self, prefix: str) -> List[str]:
+        return [term for term, _ in self.prefix_frequencies(prefix)]
+
+    def prefix_frequencies(self, prefix: str) -> List[Tuple[str, int]]:
+        # Document frequencies come from the term table, not the postings
+        if self._layer is None:
+            return [(term, self.terms.doc_count(i)) for i, term in self.terms.prefixed(prefix)]
+        return self._layer.prefixed(prefix)
+
+    @property
+    def trigrams(self) -> TrigramIndex:
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex(self.terms if self._layer is None else list(self.terms))
+        return self._trigrams
+
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        # correct_query() bisects the vocabulary, which a layer cannot index
+        terms = self.terms if self._layer is None else self.trigrams.terms
+        return correct_query(query, terms, lambda: self.trigrams)
+
+    def updated(self, changes: Dict[str, Optional[FileStat]],
+                cache: Optional[LRUCache] = None) -> "MappedIndex":
+        """
+        Return a new generation with the changed files re-indexed into the
+        layer over the snapshot, see SearchIndex.updated()
+        """
+        # The copy shares the mapping; everything an update changes is replaced
+        index = copy.copy(self)
+        index._removed = set(self._removed)
+        index._store = self._store.copy()
+        base_postings = self.postings if self._layer is None else self._layer.base
+        base_titles = self.title_postings if self._title_layer is None else self._title_layer.base
+        layer = (self._layer or _Layer(base_postings, set())).copy(index._removed)
+        title_layer = (self._title_layer or _Layer(base_titles, set())).copy(index._removed)
+        index._layer, index._title_layer = layer, title_layer
+        index.postings, index.title_postings = layer, title_layer
+        index.documents = _Documents(index)
+        index.doc_ids = dict(self.doc_ids)
+        index.doc_lengths = array('I', self.doc_lengths)
+        index.stats = dict(self.stats)
+        index.generation = self.generation + 1
+        index._fingerprint = None
+        index._trigrams = None
+        index._directories = None
+        base_count = len(self._documents)
+
+        touched: Dict[str, Dict[int, Any]] = {}
+        touched_titles: Dict[str, Dict[int, Any]] = {}
+        affected: Set[str] = set()
+        affected_titles: Set[str] = set()
+
+        def term_postings(term: str) -> Dict[int, Any]:
+            if term not in touched:
+                touched[term] = dict(layer.added.get(term, ()))
+            return touched[term]
+
+        def title_term_postings(term: str) -> Dict[int, Any]:
+            if term not in touched_titles:
+                touched_titles[term] = dict(title_layer.added.get(term, ()))
+            return touched_titles[term]
+
+        for path, stat in changes.items():
+            doc_id = index.doc_ids.pop(path, None)
+            if doc_id is not None:
+                old = index.documents[doc_id]
+                terms, title_terms = set(tokenize(old.text)), title_counts(old.title)
+                layer.remove(doc_id, terms, doc_id < base_count, term_postings)
+                title_layer.remove(doc_id, title_terms, doc_id < base_count, title_term_postings)
+                affected.update(terms)
+                affected_titles.update(title_terms)
+                index.total_length -= index.doc_lengths[doc_id]
+                index.doc_lengths[doc_id] = 0
+                if doc_id < base_count:
+                    index._removed.add(doc_id)
+                else:
+                    index._store[doc_id - base_count] = None
+
+            if stat is None:
+                index.stats.pop(path, None)
+                continue
+            index.stats[path] = stat
+
+            document = load_document(path, stat, cache)
+            if document is not None:
+                doc_id = base_count + len(index._store)
+                index._store.append(document)
+                index.doc_ids[path] = doc_id
+                positions = term_positions(document.text)
+                titles = title_counts(document.title)
+                for term, occurrences in positions.items():
+                    term_postings(term)[doc_id] = occurrences
+                for term, count in titles.items():
+                    title_term_postings(term)[doc_id] = count
+                affected.update(positions)
+                affected_titles.update(titles)
+                length = sum(len(p) for p in positions.values())
+                index.doc_lengths.append(length)
+                index.total_length += length
+
+        layer.settle(touched, affected)
+        title_layer.settle(touched_titles, affected_titles)
+        index.terms = layer.vocabulary
+        # Edited pages leave their old text behind in the layer's store
+        if index._store.wasteful:
+            index._store = index._store.compacted()
+        return index
+
+
+def open_snapshot(path: str) -> Optional[MappedIndex]:
+    """Map the snapshot at path, or return None if there is no usable one"""
+    try:
+        return MappedIndex(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable search index snapshot {path}: {str(e)}")
+        return None
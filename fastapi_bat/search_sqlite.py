@@ -0,0 +1,318 @@
+"""
+SQLite FTS5 search backend.
+
+Pages live in an FTS5 table in cache_dir next to a table with the stat of
+every file, so the database survives restarts and only pages changed in
+the meantime are re-indexed. Queries run as ranked MATCH expressions and
+snippets come from FTS5's snippet(). Each thread uses its own connection;
+in WAL mode readers never wait for the refresher writing updates.
+"""
+import functools
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from search_backend import HitKey, PathFilter, SearchHit, SearchHits, SearchView
+from search_cache import LRUCache
+from search_index import (
+    FileStat, SearchQuery, TrigramIndex, correct_query, count_sequences, file_stat, group_by_directory,
+    load_document, tokenize
+)
+from search_refresh import IndexRefresher
+
+logger = logging.getLogger(__name__)
+
+# Tokenize like search_index.tokenize(): lowercase \w+ runs
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, doc_id INTEGER);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER);
+CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(
+    path UNINDEXED, title, text, meta UNINDEXED,
+    tokenize="unicode61 remove_diacritics 0 tokenchars '_'"
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS pages_terms USING fts5vocab(pages, instance);
+CREATE VIRTUAL TABLE IF NOT EXISTS pages_vocab USING fts5vocab(pages, col);
+"""
+
+# Largest code point, closes the range of terms starting with a prefix
+PREFIX_END = "\U0010ffff"
+
+# snippet() length in tokens
+SNIPPET_TOKENS = 48
+LIVE_SNIPPET_TOKENS = 16
+
+
+def quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def fts_expression(query: SearchQuery) -> Optional[str]:
+    """
+    Translate a parsed query to an FTS5 MATCH expression over the page
+    text, or None when it has no words or phrases to match
+    """
+    parts = [quote(' '.join(phrase)) for phrase in query.phrases]
+    for i, word in enumerate(query.words):
+        alternatives = [quote(word) + ('*' if query.prefix and i == len(query.words) - 1 else '')]
+        alternatives.extend(quote(variant) for variant in query.variants.get(word, ()))
+        parts.append(alternatives[0] if len(alternatives) == 1 else '(' + ' OR '.join(alternatives) + ')')
+    if not parts:
+        return None
+    expression = ' AND '.join(parts)
+    for phrase in query.excluded:
+        expression = f"({expression}) NOT {quote(' '.join(phrase))}"
+    return f"text : ({expression})"
+
+
+class SqliteHits(SearchHits):
+    """Hits read from a ranked MATCH query as they are consumed"""
+
+    def __init__(self, store: "SqliteStore", query: SearchQuery, filter_pattern: str,
+                 live_search: Optional[str], cursor: Optional[HitKey], candidates: Optional[int] = None):
+        self.store = store
+        self.query = query
+        # Ids of the pages the filter lets through, None for all of them
+        self.allowed = PathFilter(filter_pattern).documents(store.directories)
+        self.expression = fts_expression(query) if self.allowed != set() else None
+        self.seen: Set[int] = set()
+        self._counts: Optional[Dict[int, int]] = None
+        self.snippet_tokens = LIVE_SNIPPET_TOKENS if live_search else SNIPPET_TOKENS
+        self._rows = iter(())
+        if self.expression is not None:
+            # No snippet() here: SQLite would compute one for every match
+            # while sorting, before the first row is returned
+            sql = "SELECT rowid, rank, path, title, meta FROM pages WHERE pages MATCH ?"
+            params: List[Any] = [self.expression]
+            if cursor:
+                sql += " AND (rank, rowid) > (?, ?)"
+                params.extend(cursor)
+            if candidates is not None:
+                # Only the first matches in rowid order get ranked
+                sql += " AND rowid IN (SELECT rowid FROM pages WHERE pages MATCH ? LIMIT ?)"
+                params.extend((self.expression, candidates))
+            self._rows = store.connection().execute(sql + " ORDER BY rank, rowid", params)
+
+    def counts(self) -> Dict[int, int]:
+        """Occurrences of the query words and phrases in the text of every page containing them"""
+        if self._counts is None:
+            conn = self.store.connection()
+            counts: Dict[int, int] = {}
+            conditions = []
+            for i, word in enumerate(self.query.words):
+                if self.query.prefix and i == len(self.query.words) - 1:
+                    conditions.append(("term >= ? AND term < ?", (word, word + PREFIX_END)))
+                else:
+                    conditions.append(("term = ?", (word,)))
+                conditions.extend(("term = ?", (variant,)) for variant in self.query.variants.get(word, ()))
+            for condition, params in conditions:
+                for doc_id, count in conn.execute(
+                        f"SELECT doc, count(*) FROM pages_terms WHERE {condition} AND col = 'text' GROUP BY doc",
+                        params):
+                    counts[doc_id] = counts.get(doc_id, 0) + count
+            # A phrase counts where all of its words occur in sequence
+            for phrase in self.query.phrases:
+                word_positions = []
+                for word in phrase:
+                    positions: Dict[int, List[int]] = {}
+                    for doc_id, offset in conn.execute(
+                            "SELECT doc, offset FROM pages_terms WHERE term = ? AND col = 'text' ORDER BY doc, offset",
+                            (word,)):
+                        positions.setdefault(doc_id, []).append(offset)
+                    word_positions.append(positions)
+                for doc_id in set(word_positions[0]).intersection(*word_positions[1:]):
+                    count = count_sequences([positions[doc_id] for positions in word_positions])
+                    if count:
+                        counts[doc_id] = counts.get(doc_id, 0) + count
+            self._counts = counts
+        return self._counts
+
+    def __iter__(self) -> Iterator[SearchHit]:
+        for doc_id, rank, path, title, meta in self._rows:
+            if not self._allows(doc_id):
+                continue
+            self.seen.add(doc_id)
+            yield SearchHit(path, title, json.loads(meta), self.counts().get(doc_id, 0), (rank, doc_id),
+                            functools.partial(self.snippet, doc_id))
+
+    def snippet(self, doc_id: int) -> str:
+        """FTS5 snippet of the page text, only computed for the hits that get returned"""
+        row = self.store.connection().execute(
+            "SELECT snippet(pages, 2, '<span class=\"search\">', '</span>', '', ?) FROM pages "
+            "WHERE rowid = ? AND pages MATCH ?", (self.snippet_tokens, doc_id, self.expression)).fetchone()
+        return row[0] if row else ""
+
+    def _allows(self, doc_id: int) -> bool:
+        return self.allowed is None or doc_id in self.allowed
+
+    def unseen(self) -> Tuple[int, int, bool]:
+        if self.expression is None:
+            return 0, 0, False
+        # Only up to the next allowed row; the count comes from one
+        # unordered query over every match
+        more = any(self._allows(row[0]) for row in self._rows)
+        count = matches = 0
+        rows = self.store.connection().execute("SELECT rowid FROM pages WHERE pages MATCH ?", (self.expression,))
+        for doc_id, in rows:
+            if doc_id not in self.seen and self._allows(doc_id):
+                count += 1
+                matches += self.counts().get(doc_id, 0)
+        return count, matches, more
+
+
+class SqliteStore(SearchView):
+    """
+    The FTS5 database, updated in place.
+
+    It offers the parts of the SearchIndex interface IndexRefresher relies
+    on (stats, generation and updated()), so the refresher keeps it in sync
+    with the files exactly like the in-memory index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._vocabulary: Optional[Tuple[int, List[str], TrigramIndex]] = None
+        self._directories: Optional[Tuple[int, Dict[str, List[Tuple[str, int]]]]] = None
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        self.stats: Dict[str, FileStat] = {
+            path: (mtime_ns, size) for path, mtime_ns, size in conn.execute("SELECT path, mtime_ns, size FROM files")
+        }
+        row = conn.execute("SELECT value FROM state WHERE key = 'generation'").fetchone()
+        self.generation = row[0] if row else 0
+
+    def connection(self) -> sqlite3.Connection:
+        """The connection of the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @property
+    def fingerprint(self) -> str:
+        return f"sqlite:{self.path}:{self.generation}"
+
+    def updated(self, changes: Dict[str, Optional[FileStat]],
+                cache: Optional[LRUCache] = None, replace: bool = False) -> "SqliteStore":
+        """
+        Upsert the changed files in one transaction and return the store.
+        With replace, the changed files become the only ones in the store;
+        readers keep seeing the previous pages until the transaction commits.
+        """
+        conn = self.connection()
+        stats = {} if replace else dict(self.stats)
+        with self._write_lock, conn:
+            if replace:
+                conn.execute("DELETE FROM pages")
+                conn.execute("DELETE FROM files")
+            for path, stat in changes.items():
+                row = conn.execute("SELECT doc_id FROM files WHERE path = ?", (path,)).fetchone()
+                if row and row[0] is not None:
+                    conn.execute("DELETE FROM pages WHERE rowid = ?", (row[0],))
+                if stat is None:
+                    conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                    stats.pop(path, None)
+                    continue
+
+                doc_id = None
+                document = load_document(path, stat, cache)
+                if document is not None:
+                    doc_id = conn.execute(
+                        "INSERT INTO pages (path, title, text, meta) VALUES (?, ?, ?, ?)",
+                        (document.path, document.title, document.text, json.dumps(document.meta))
+                    ).lastrowid
+                conn.execute(
+                    "INSERT INTO files (path, mtime_ns, size, doc_id) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size, "
+                    "doc_id = excluded.doc_id",
+                    (path, stat[0], stat[1], doc_id)
+                )
+                stats[path] = stat
+            conn.execute("INSERT INTO state (key, value) VALUES ('generation', ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (self.generation + 1,))
+        self.stats = stats
+        self.generation += 1
+        return self
+
+    def hits(self, query: SearchQuery, filter_pattern: str, live_search: Optional[str],
+             cursor: Optional[HitKey] = None, candidates: Optional[int] = None) -> SearchHits:
+        return SqliteHits(self, query, filter_pattern, live_search, cursor, candidates)
+
+    def vocabulary(self) -> Tuple[List[str], TrigramIndex]:
+        """Sorted terms of the page text and their trigram index, rebuilt per generation"""
+        vocabulary = self._vocabulary
+        if vocabulary is None or vocabulary[0] != self.generation:
+            generation = self.generation
+            terms = [term for term, in self.connection().execute(
+                "SELECT term FROM pages_vocab WHERE col = 'text' ORDER BY term")]
+            vocabulary = self._vocabulary = (generation, terms, TrigramIndex(terms))
+        return vocabulary[1], vocabulary[2]
+
+    @property
+    def directories(self) -> Dict[str, List[Tuple[str, int]]]:
+        """Pages by directory, re-read per generation"""
+        directories = self._directories
+        if directories is None or directories[0] != self.generation:
+            generation = self.generation
+            rows = self.connection().execute("SELECT path, doc_id FROM files WHERE doc_id IS NOT NULL")
+            directories = self._directories = (generation, group_by_directory(rows))
+        return directories[1]
+
+    def fuzzy_query(self, query: SearchQuery) -> SearchQuery:
+        terms, trigrams = self.vocabulary()
+        return correct_query(query, terms, lambda: trigrams)
+
+    def complete(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """
+        Completions of the last word of query by the number of pages
+        containing them together with all the preceding words, like
+        SearchIndex.complete()
+        """
+        words = tokenize(query)
+        if not words or limit <= 0:
+            return []
+        prefix = words[-1]
+        if len(words) == 1:
+            return list(self.connection().execute(
+                "SELECT term, doc FROM pages_vocab WHERE col = 'text' AND term >= ? AND term < ? "
+                "ORDER BY doc DESC, term LIMIT ?", (prefix, prefix + PREFIX_END, limit)))
+        expression = "text : (" + " AND ".join(quote(word) for word in words[:-1]) + ")"
+        return list(self.connection().execute(
+            "SELECT term, count(DISTINCT doc) AS docs FROM pages_terms "
+            "WHERE col = 'text' AND term >= ? AND term < ? AND doc IN (SELECT rowid FROM pages WHERE pages MATCH ?) "
+            "GROUP BY term ORDER BY docs DESC, term LIMIT ?", (prefix, prefix + PREFIX_END, expression, limit)))
+
+    def describe(self) -> Dict[str, Any]:
+        conn = self.connection()
+        return {"backend": "sqlite", "generation": self.generation,
+                "documents": conn.execute("SELECT count(*) FROM files WHERE doc_id IS NOT NULL").fetchone()[0],
+                "terms": conn.execute("SELECT count(DISTINCT term) FROM pages_vocab").fetchone()[0]}
+
+
+class SqliteRefresher(IndexRefresher):
+    """IndexRefresher keeping a SqliteStore at database_path in sync"""
+
+    def __init__(self, list_files, search_dir: str, extensions: List[str], database_path: str, **kwargs):
+        super().__init__(list_files, search_dir, extensions, **kwargs)
+        self.database_path = database_path
+
+    def _load_or_build(self) -> SqliteStore:
+        store = SqliteStore(self.database_path)
+        changes = self._changed(store, set(self.list_files()) | set(store.stats))
+        logger.info(f"Opened search database {self.database_path}, {len(changes)} files changed since")
+        return store.updated(changes, self.document_cache) if changes else store
+
+    def rebuild(self) -> SqliteStore:
+        """Re-index every page from scratch in one transaction, so queries never see an empty store"""
+        store = self.get_index()
+        with self._lock:
+            stats = {path: file_stat(path) for path in self.list_files()}
+            store.updated({path: stat for path, stat in stats.items() if stat is not None}, self.document_cache,
+                          replace=True)
+        self._published(store)
+        return store
@@ -0,0 +1,62 @@
+"""
+Result templates compiled once into a render plan.
+
+A template such as "<a href='#{href}'>#{title}</a> #{description}" is split
+into literal segments and slots. #{title}, #{href}, #{token} and #{count}
+are the result fields; any other #{name} is filled from the page meta tag of
+that name, which is extracted when the page is indexed.
+"""
+import re
+from typing import Dict, List, Tuple
+from search_cache import LRUCache
+
+SLOT_RE = re.compile(r'#\{([a-z]*)\}', re.IGNORECASE)
+FIELDS = ('title', 'href', 'token', 'count')
+
+# Plans are small, so this holds thousands of distinct templates
+TEMPLATE_CACHE_SIZE = 1024 * 1024
+
+
+class TemplatePlan:
+    """Literal segments of a template interleaved with the slots between them"""
+
+    def __init__(self, template: str):
+        self.size = len(template)
+        self.literals: List[str] = []
+        # (is_meta, name) for every slot; literals has one more entry
+        self.slots: List[Tuple[bool, str]] = []
+
+        position = 0
+        for match in SLOT_RE.finditer(template):
+            name = match.group(1)
+            if name not in FIELDS and name.lower().startswith(FIELDS):
+                # e.g. #{Title} or #{titles}: not a slot, kept verbatim
+                continue
+            self.literals.append(template[position:match.start()])
+            self.slots.append((False, name) if name in FIELDS else (True, name.lower()))
+            position = match.end()
+        self.literals.append(template[position:])
+
+    @property
+    def meta(self) -> List[str]:
+        """Names of the meta tags the template uses"""
+        return [name for is_meta, name in self.slots if is_meta]
+
+    def render(self, fields: Dict[str, str], meta: Dict[str, str]) -> str:
+        parts = [self.literals[0]]
+        for (is_meta, name), literal in zip(self.slots, self.literals[1:]):
+            parts.append(meta.get(name, '') if is_meta else fields[name])
+            parts.append(literal)
+        return ''.join(parts)
+
+
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE, sizeof=lambda plan: plan.size)
+
+
+def compile_template(template: str) -> TemplatePlan:
+    """Return the render plan of template, compiling it on first use"""
+    plan = template_cache.get(template)
+    if plan is None:
+        plan = TemplatePlan(template)
+        template_cache.put(template, plan)
+    return plan
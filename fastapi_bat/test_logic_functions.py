@@ -1,10 +1,24 @@
 import pytest
+import json
 import os
+import threading
 import tempfile
 from pathlib import Path
 from config import Settings, settings
 from main import create_email_template, load_config
-from search import list_files, find_in_text, get_file_extension
+from search import RESPONSE_FORMAT, list_files, find_in_text, get_file_extension, search, run_search, run_suggest
+from search_backend import PathFilter, make_snippet
+from search_index import (
+    Document, DocumentStore, TrigramIndex, build_index, build_index_parallel, edit_distance, file_stat, parse_document, parse_html, parse_query
+)
+from search_refresh import IndexRefresher, SharedIndexRefresher
+from search_sqlite import SqliteRefresher
+from search_shards import ShardedRefresher
+from search_snapshot import MappedIndex, open_snapshot, write_snapshot
+from search_cache import LRUCache, ResultCache, SharedCache, SingleFlight
+from search_template import TemplatePlan, compile_template
+from compression import ENCODINGS, PrecompressedStaticFiles, choose_encoding, precompress
+from benchmark import Uncoalesced, benchmark, generate_corpus, make_requests, make_vocabulary, serving
 from recaptcha import verify_recaptcha
 from pydantic import ValidationError
 from fastapi import HTTPException
@@ -212,6 +226,1102 @@ class TestSearchFunctions:
             assert "test.txt" not in file_paths
 
 
+class FakeRedis:
+    """Мінімальна заміна клієнта Redis у пам'яті для тестів спільного кешу"""
+    
+    def __init__(self):
+        self.data = {}
+        self.down = False
+    
+    def _check(self):
+        if self.down:
+            raise ConnectionError("redis is down")
+    
+    def get(self, name):
+        self._check()
+        return self.data.get(name)
+    
+    def set(self, name, value, ex=None):
+        self._check()
+        self.data[name] = value
+    
+    def incr(self, name):
+        self._check()
+        self.data[name] = str(int(self.data.get(name, 0)) + 1).encode('ascii')
+        return int(self.data[name])
+
+
+class TestSearchIndex:
+    """Тестування інвертованого індексу пошуку"""
+    
+    def _write_site(self, temp_dir):
+        """Створює тестовий сайт з кількома сторінками"""
+        pages = {
+            "index.html": "<html><head><title>Home</title><meta name='description' content='Main page'></head>"
+                          "<body><h1>FastAPI server</h1><p>Docker images for the FastAPI server</p></body></html>",
+            "about.html": "<html><head><title>About</title></head><body><p>About our Docker setup</p></body></html>",
+            "empty.html": "",
+        }
+        for name, content in pages.items():
+            (Path(temp_dir) / name).write_text(content)
+        return [str(Path(temp_dir) / name) for name in pages]
+    
+    def test_parse_html(self):
+        """Тестування видобування заголовка, тексту та мета-тегів"""
+        document = parse_html("page.html", "<title>Title</title><meta name=\"Author\" content=\"Me\">"
+                                           "<body class='x'><p>Hello   <b>world</b></p></body>")
+        
+        assert document.title == "Title"
+        assert document.text == "Hello world"
+        assert document.meta == {"author": "Me"}
+    
+    def test_parse_document_in_chunks(self):
+        """Тестування потокового видобування тексту: скрипти, стилі, сутності та великі сторінки"""
+        html = ("<html><head><title>Big  page</title><style>p { color: red }</style>"
+                "<meta content='Guide' name='Description'></head><body><script>var a = '<b>';</script>"
+                + "<p>Tom &amp; Jerry</p>" * 5000 + "</body><p>after body</p></html>")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "big.html"
+            path.write_text(html)
+            
+            with patch("search_index.CHUNK_SIZE", 1000):
+                document = parse_document(str(path))
+        
+        assert document.title == "Big page"
+        assert document.meta == {"description": "Guide"}
+        assert document.text == " ".join(["Tom & Jerry"] * 5000)
+        assert parse_html("page.html", html).text == document.text
+        # Незакритий тег не призводить до катастрофічного перебору
+        assert parse_html("page.html", "<body>" + "<" * 100000).title == ""
+    
+    def test_build_index(self):
+        """Тестування побудови індексу з позиціями термінів"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            index = build_index(files)
+            
+            # Порожній файл не індексується
+            assert len(index) == 2
+            assert index.documents[0].title == "Home"
+            assert {doc_id: list(p) for doc_id, p in index.postings["fastapi"].items()} == {0: [0, 6]}
+            assert {doc_id: list(p) for doc_id, p in index.postings["docker"].items()} == {0: [2], 1: [2]}
+            assert index.title_postings["home"] == {0: 1}
+            assert list(index.doc_lengths) == [8, 4]
+            assert index.total_length == 12
+    
+    def test_candidates(self):
+        """Тестування пошуку документів-кандидатів за запитом"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            assert index.candidates("docker") == [0, 1]
+            assert index.candidates("fastapi server") == [0]
+            # Останнє слово шукається як префікс
+            assert index.candidates("dock") == [0, 1]
+            assert index.candidates("about dock") == [1]
+            assert index.candidates("missing") == []
+            assert index.candidates("") == []
+    
+    def test_parse_query(self):
+        """Тестування розбору запиту на слова, фрази та виключення"""
+        query = parse_query('FastAPI "docker images" -about -"our setup" e-mail serv')
+        
+        assert query.words == ["fastapi", "serv"]
+        assert query.phrases == [["docker", "images"], ["e", "mail"]]
+        assert query.excluded == [["about"], ["our", "setup"]]
+        assert query.prefix
+        assert not parse_query('docker "fast').prefix
+        assert parse_query('docker "fast').phrases == []
+        assert parse_query('docker "fast').words == ["docker", "fast"]
+    
+    def test_phrases_and_exclusions(self):
+        """Тестування фраз у лапках і виключених слів"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            assert index.candidates('"docker images"') == [0]
+            assert index.candidates('"images docker"') == []
+            # Фраза перевіряється за позиціями, а не лише за наявністю слів
+            assert index.candidates('"fastapi images"') == []
+            assert index.candidates('"the fastapi server"') == [0]
+            assert index.candidates('docker -fastapi') == [1]
+            assert index.candidates('docker -"docker setup"') == [0]
+            assert index.candidates('docker -"our setup"') == [0, 1]
+            assert index.candidates('-docker') == []
+            assert [Path(index.doc_path(i)).name for i in index.rank('"our docker" setup')] == ["about.html"]
+            # Фраза рахується як один збіг, а не як збіги кожного її слова
+            assert index.rank('"the fastapi server"').matches(0) == 1
+            assert index.rank('"fastapi server" docker').matches(0) == 3
+    
+    def test_fuzzy_search(self):
+        """Тестування пошуку з помилками через триграмний індекс словника"""
+        assert edit_distance("dokcer", "docker", 2) == 2
+        assert edit_distance("kitten", "sitting", 1) == 2
+        assert TrigramIndex(["docker", "dock", "fastapi"]).similar("dockr", 1) == ["dock", "docker"]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            assert run_search(index, "fastapy", "*", "#{title}", None, None)["results_count"] == 0
+            response = run_search(index, "fastapy", "*", "#{title}", None, None, True)
+            assert response["results_count"] == 1
+            assert '<span class="search">FastAPI</span>' in response["results"][0]["snippet"]
+            
+            # Відомі слова та короткі слова не виправляються
+            query = index.fuzzy_query(parse_query("docker serer abot"))
+            assert query.variants == {"serer": ["server"], "abot": ["about"]}
+            assert index.fuzzy_query(parse_query("dokr")).variants == {}
+    
+    def test_document_store(self):
+        """Тестування компактного сховища документів у спільному буфері UTF-8"""
+        store = DocumentStore()
+        store.append(Document("a.html", "Головна", "Текст сторінки", {"description": "Опис"}))
+        store.append(Document("b.html", "About", "Plain text", {}))
+        assert len(store) == 2
+        assert store.path(0) == "a.html"
+        assert store[0].text == "Текст сторінки"
+        assert store[0].meta == {"description": "Опис"}
+        
+        # Наступне покоління спільно використовує буфер і лише дописує до нього
+        next_store = store.copy()
+        next_store[0] = None
+        next_store.append(Document("c.html", "New", "New text", {}))
+        assert store[0].title == "Головна"
+        assert next_store[0] is None
+        assert next_store[2].path == "c.html"
+        assert next_store._buffer is store._buffer
+        
+        # Гілка від старого покоління отримує власну копію буфера
+        other = store.copy()
+        other.append(Document("d.html", "Other", "Other text", {}))
+        assert other[2].path == "d.html"
+        assert next_store[2].path == "c.html"
+        assert other._buffer is not store._buffer
+        assert [document.path for document in other] == ["a.html", "b.html", "d.html"]
+        
+        with pytest.raises(IndexError):
+            store[2]
+    
+    def test_document_store_stays_bounded(self):
+        """Тестування того, що повторні правки сторінки не роздувають буфер документів"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            index = build_index(files)
+            page = Path(files[0])
+            body = "docker " * 20000
+            for i in range(50):
+                page.write_text(f"<html><head><title>Edit {i}</title></head><body>{body}{i}</body></html>")
+                index = index.updated({files[0]: file_stat(files[0])})
+            
+            live = sum(len(document.path.encode()) + len(document.title.encode()) + len(document.text.encode())
+                       + len(json.dumps(document.meta).encode()) for document in index.documents if document)
+            assert len(index.documents._buffer.data) <= live * 2 + 1024
+            assert index.documents.dead_bytes <= index.documents.size * DocumentStore.MAX_DEAD_SHARE
+            assert index.documents[index.doc_ids[files[0]]].title == "Edit 49"
+            assert run_search(index, "docker", "*", "#{title}", None, None)["results_count"] == 2
+    
+    def test_refresh_reindexes_changed_files(self):
+        """Тестування інкрементального оновлення індексу за mtime/розміром"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            published = []
+            refresher = IndexRefresher(lambda: list_files(temp_dir, ["html"]), temp_dir, ["html"], use_watcher=False,
+                                       on_publish=published.append)
+            old_index = refresher.get_index()
+            
+            # Без змін файли не перечитуються і покоління не змінюється
+            with patch("search_index.load_document") as load_mock:
+                assert refresher.refresh() is old_index
+                load_mock.assert_not_called()
+            assert published == []
+            
+            Path(files[1]).write_text("<html><body><p>Kubernetes deployment notes</p></body></html>")
+            (Path(temp_dir) / "new.html").write_text("<html><body><p>Fresh docker page</p></body></html>")
+            Path(files[0]).unlink()
+            new_index = refresher.refresh()
+            
+            assert new_index.generation == old_index.generation + 1
+            assert published == [new_index]
+            assert len(new_index) == 2
+            assert new_index.candidates("kubernetes") == [new_index.doc_ids[files[1]]]
+            assert [new_index.documents[i].path for i in new_index.candidates("docker")] == [str(Path(temp_dir) / "new.html")]
+            assert "fastapi" not in new_index.postings
+            assert new_index.expand_prefix("kube") == ["kubernetes"]
+            
+            # Попереднє покоління залишається незмінним для запитів, що виконуються
+            assert old_index.candidates("docker") == [0, 1]
+            assert "kubernetes" not in old_index.postings
+    
+    def test_build_index_parallel(self):
+        """Тестування паралельної побудови індексу в пулі процесів"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(450):
+                (Path(temp_dir) / f"page{i:03}.html").write_text(
+                    f"<html><head><title>Page {i}</title></head><body><p>word{i % 7} shared text {i}</p></body></html>")
+            files = sorted(list_files(temp_dir, ["html"]))
+            
+            sequential = build_index(files)
+            parallel = build_index_parallel(files, workers=2)
+            
+            assert [d.path for d in parallel.documents] == [d.path for d in sequential.documents]
+            assert parallel.postings == sequential.postings
+            assert parallel.terms == sequential.terms
+            assert parallel.fingerprint == sequential.fingerprint
+    
+    def test_bm25_ranking(self):
+        """Тестування ранжування BM25 з підсиленням заголовка"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pages = {
+                "body.html": "<title>Notes</title><body><p>docker docker and some other words here</p></body>",
+                "title.html": "<title>Docker guide</title><body><p>docker intro</p></body>",
+                "rare.html": "<title>Misc</title><body><p>one docker mention in a long page about many things</p></body>",
+            }
+            for name, content in pages.items():
+                (Path(temp_dir) / name).write_text(content)
+            index = build_index(sorted(list_files(temp_dir, ["html"])))
+            paths = [Path(index.doc_path(doc_id)).name for doc_id in index.rank("docker")]
+            
+            # Збіг у заголовку переважає, довга сторінка з одним збігом остання
+            assert paths == ["title.html", "body.html", "rare.html"]
+            
+            ranking = index.rank("docker")
+            assert ranking.matches(index.doc_ids[str(Path(temp_dir) / "body.html")]) == 2
+            assert len(index.rank("missing")) == 0
+            
+            # Для підказок ранжується обмежена кількість кандидатів, спершу збіги в заголовку
+            capped = index.rank_query(parse_query("docker"), None, 1)
+            assert [Path(index.doc_path(doc_id)).name for doc_id in capped] == ["title.html"]
+            assert len(index.rank_query(parse_query("docker"), None, 2)) == 2
+    
+    def test_live_search_stops_at_live_count(self):
+        """Тестування живого пошуку: обробляються лише найкращі liveCount сторінок"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(20):
+                (Path(temp_dir) / f"page{i:02}.html").write_text(f"<body><p>common word {'common ' * i}</p></body>")
+            index = build_index(sorted(list_files(temp_dir, ["html"])))
+            
+            with patch("search_backend.make_snippet", wraps=make_snippet) as snippet_mock:
+                response = run_search(index, "common", "*", "#{href}", 3, "live")
+            
+            assert snippet_mock.call_count == 3
+            assert len(response["results"]) == 3
+            # Загальна кількість береться з індексу без сканування решти сторінок
+            assert response["results_count"] == 20
+            assert response["total_matches"] == sum(i + 1 for i in range(20))
+            assert response["results"][0]["href"].endswith("page19.html")
+    
+    def test_suggest(self):
+        """Тестування підказок для живого пошуку за префіксом"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            assert index.complete("do") == [("docker", 2)]
+            assert index.complete("se") == [("server", 1), ("setup", 1)]
+            # Доповнення враховують попередні слова запиту
+            assert index.complete("about se") == [("setup", 1)]
+            assert index.complete("zzz") == []
+            
+            response = run_suggest(index, "Our se", 5)
+            assert response["suggestions"] == [{"text": "Our setup", "count": 1}]
+            assert response["documents"] == [{"title": "About", "href": str(Path(temp_dir) / "about.html")}]
+            
+            # Виключене слово чи фраза в кінці не доповнюються і не замінюють слова запиту
+            for s in ("server -do", 'server "do'):
+                assert run_suggest(index, s, 5) == {"query": s, "suggestions": [], "documents": []}
+            # Виключені слова перед доповнюваним не звужують доповнення
+            assert run_suggest(index, "-about se", 5)["suggestions"] == [{"text": "-about server", "count": 1},
+                                                                         {"text": "-about setup", "count": 1}]
+    
+    def test_snapshot_roundtrip(self):
+        """Тестування запису та відображення в пам'ять знімка індексу"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            index = build_index(files)
+            # Видалений документ не залишає дірок у знімку
+            index = index.updated({files[1]: None})
+            snapshot_path = str(Path(temp_dir) / "index.bin")
+            write_snapshot(index, snapshot_path)
+            
+            mapped = open_snapshot(snapshot_path)
+            assert isinstance(mapped, MappedIndex)
+            assert mapped.fingerprint == index.fingerprint
+            assert mapped.generation == index.generation
+            assert mapped.stats == index.stats
+            assert len(mapped) == 1
+            assert list(mapped.terms) == index.terms
+            assert mapped.candidates("fastapi serv") == [0]
+            assert mapped.candidates("about") == []
+            assert list(mapped.postings["fastapi"][0]) == [0, 6]
+            
+            document = mapped.documents[mapped.doc_ids[files[0]]]
+            assert document.title == "Home"
+            assert document.meta == {"description": "Main page"}
+            assert list(mapped.doc_lengths) == [8]
+            assert mapped.title_postings.get("home") == {0: 1}
+            assert run_search(mapped, "docker", "*", "#{title}", None, None) == \
+                run_search(index, "docker", "*", "#{title}", None, None)
+            
+            # Зміни після запису знімка лягають шаром поверх нього, а не копіюють індекс у пам'ять
+            Path(files[0]).write_text("<html><head><title>Nginx</title></head><body><p>Nginx in front of "
+                                      "the FastAPI server</p></body></html>")
+            Path(files[1]).write_text("<html><body><p>Docker compose notes</p></body></html>")
+            changes = {files[0]: file_stat(files[0]), files[1]: file_stat(files[1])}
+            layered, index = mapped.updated(changes), index.updated(changes)
+            assert isinstance(layered, MappedIndex) and layered.overlaid and not mapped.overlaid
+            assert layered.documents[0] is None and mapped.documents[0].title == "Home"
+            assert list(layered.terms) == index.terms
+            assert sorted(layered.title_postings) == sorted(index.title_postings)
+            assert layered.fingerprint == index.fingerprint
+            assert layered.expand_prefix("do") == index.expand_prefix("do") == ["docker"]
+            assert "images" not in layered.postings and "images" in mapped.postings
+            for query in ["docker", "fastapi", "nginx", "notes", "ser"]:
+                assert run_search(layered, query, "*", "#{title}", None, None) == \
+                    run_search(index, query, "*", "#{title}", None, None), query
+            # Знімок шаруватого індексу відповідає індексу в пам'яті
+            write_snapshot(layered, snapshot_path)
+            remapped = open_snapshot(snapshot_path)
+            assert list(remapped.terms) == index.terms
+            assert run_search(remapped, "nginx", "*", "#{title}", None, None) == \
+                run_search(index, "nginx", "*", "#{title}", None, None)
+            
+            # Пошкоджений файл ігнорується
+            Path(snapshot_path).write_bytes(b"garbage")
+            assert open_snapshot(snapshot_path) is None
+    
+    def test_refresher_uses_snapshot(self):
+        """Тестування старту зі знімка з перевіркою змін за mtime/розміром"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            snapshot_path = str(Path(temp_dir) / "index.bin")
+            list_site = lambda: list_files(temp_dir, ["html"])
+            
+            # Перший старт будує індекс і записує знімок
+            IndexRefresher(list_site, temp_dir, ["html"], use_watcher=False,
+                           snapshot_path=snapshot_path).get_index()
+            assert Path(snapshot_path).exists()
+            
+            # Незмінений сайт відкривається зі знімка без розбору сторінок
+            with patch("search_index.parse_document") as parse_mock:
+                index = IndexRefresher(list_site, temp_dir, ["html"], use_watcher=False,
+                                       snapshot_path=snapshot_path).get_index()
+                parse_mock.assert_not_called()
+            assert isinstance(index, MappedIndex)
+            
+            # Сторінка, змінена після запису знімка, переіндексовується при старті
+            Path(files[1]).write_text("<html><body><p>Updated after the build</p></body></html>")
+            with patch("search_index.parse_document", wraps=parse_document) as parse_mock:
+                index = IndexRefresher(list_site, temp_dir, ["html"], use_watcher=False,
+                                       snapshot_path=snapshot_path).get_index()
+                parse_mock.assert_called_once_with(files[1])
+            assert index.candidates("updated") == [index.doc_ids[files[1]]]
+            assert index.candidates("fastapi") == [index.doc_ids[files[0]]]
+            assert isinstance(index, MappedIndex)
+    
+    def test_shared_index_across_workers(self):
+        """Тестування спільного індексу: один процес індексує, інші відображають знімок"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            site = Path(temp_dir) / "site"
+            site.mkdir()
+            files = self._write_site(str(site))
+            snapshot_path = str(Path(temp_dir) / "search_index.bin")
+            
+            def worker():
+                return SharedIndexRefresher(lambda: list_files(str(site), ["html"]), str(site), ["html"],
+                                            use_watcher=False, snapshot_path=snapshot_path, wait_timeout=5,
+                                            save_delay=60)
+            
+            leader, follower = worker(), worker()
+            try:
+                leader.get_index()
+                with patch("search_refresh.build_index_parallel") as build_mock:
+                    index = follower.get_index()
+                    build_mock.assert_not_called()
+                assert leader.leader and not follower.leader
+                assert isinstance(index, MappedIndex)
+                assert index.candidates("docker") == [0, 1]
+                
+                # Лідер публікує нове покоління, послідовник перемикається на нього без індексації
+                Path(files[1]).write_text("<html><body><p>Kubernetes notes</p></body></html>")
+                # Знімок записується у фоні із затримкою, а не під час оновлення
+                with patch("search_refresh.write_snapshot") as write_mock:
+                    new_index = leader.refresh()
+                    write_mock.assert_not_called()
+                assert follower.refresh() is index
+                leader.flush()
+                with patch("search_index.load_document") as load_mock:
+                    switched = follower.refresh()
+                    load_mock.assert_not_called()
+                assert switched.generation == new_index.generation == index.generation + 1
+                assert isinstance(switched, MappedIndex)
+                assert len(switched.candidates("kubernetes")) == 1
+                assert follower.refresh() is switched
+                
+                # Після зупинки лідера його роль переходить до послідовника
+                leader.stop()
+                Path(files[0]).write_text("<html><body><p>Nginx notes</p></body></html>")
+                taken_over = follower.refresh()
+                assert follower.leader
+                assert len(taken_over.candidates("nginx")) == 1
+                follower.flush()
+                assert open_snapshot(snapshot_path).generation == taken_over.generation
+            finally:
+                leader.stop()
+                follower.stop()
+    
+    def test_sqlite_backend(self):
+        """Тестування пошуку через SQLite FTS5 з інкрементальним оновленням"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            database = str(Path(temp_dir) / "search.sqlite3")
+            refresher = SqliteRefresher(lambda: list_files(temp_dir, ["html"]), temp_dir, ["html"], database,
+                                        use_watcher=False)
+            store = refresher.get_index()
+            
+            response = run_search(store, "docker", "*", "#{title}|#{count}|#{description}", None, None)
+            assert response["results_count"] == 2
+            assert sorted(result["formatted"] for result in response["results"]) == ["About|1|", "Home|1|Main page"]
+            assert '<span class="search">Docker</span>' in response["results"][0]["snippet"]
+            
+            phrase = run_search(store, '"docker images"', "*", "#{title}", None, None)
+            assert phrase["results_count"] == 1
+            assert phrase["total_matches"] == 1
+            assert run_search(store, "docker -fastapi", "*", "#{title}", None, None)["results"][0]["title"] == "About"
+            assert run_search(store, "serv", "*", "#{title}", None, None)["total_matches"] == 2
+            assert run_search(store, "fastapy", "*", "#{title}", None, None, True)["results_count"] == 1
+            
+            page = run_search(store, "docker", "*", "#{title}", None, None, False, 1)
+            assert page["results_count"] == 2
+            rest = run_search(store, "docker", "*", "#{title}", None, None, False, 1, page["next_cursor"])
+            assert [r["title"] for r in page["results"] + rest["results"]] == [r["title"] for r in response["results"]]
+            assert rest["next_cursor"] is None
+            
+            assert run_suggest(store, "se", 5)["suggestions"] == [{"text": "server", "count": 1}, {"text": "setup", "count": 1}]
+            # Попередні слова звужують доповнення так само, як в індексі в пам'яті
+            index = build_index(files)
+            for query in ["fastapi do", "about do", "kubernetes do"]:
+                assert store.complete(query, 5) == index.complete(query, 5), query
+            
+            # Змінені файли оновлюються в базі, а база переживає перезапуск
+            Path(files[1]).write_text("<html><body><p>Kubernetes notes</p></body></html>")
+            store = refresher.refresh()
+            assert run_search(store, "docker", "*", "#{title}", None, None)["results_count"] == 1
+            reopened = SqliteRefresher(lambda: list_files(temp_dir, ["html"]), temp_dir, ["html"], database,
+                                       use_watcher=False)
+            with patch("search_sqlite.load_document") as load_mock:
+                store = reopened.get_index()
+                load_mock.assert_not_called()
+            assert run_search(store, "kubernetes", "*", "#{href}", None, None)["results"][0]["href"] == files[1]
+            
+            # Під час повної переіндексації запити з інших потоків бачать попередній вміст бази
+            from search_sqlite import load_document
+            seen = []
+            
+            def load_and_query(*args):
+                thread = threading.Thread(target=lambda: seen.append(
+                    run_search(store, "kubernetes", "*", "#{title}", None, None)["results_count"]))
+                thread.start()
+                thread.join()
+                return load_document(*args)
+            
+            with patch("search_sqlite.load_document", side_effect=load_and_query):
+                reopened.rebuild()
+            assert seen and all(count == 1 for count in seen)
+            assert run_search(store, "kubernetes", "*", "#{title}", None, None)["results_count"] == 1
+    
+    def test_path_filter(self):
+        """Тестування фільтра шляхів, що відсікає цілі каталоги"""
+        paths = ["../site/index.html", "../site/docs/a.html", "../site/docs/api/b.htm", "../blog/docs/c.html",
+                 "/srv/docs/d.html", "e.html"]
+        for pattern in ["*", "*.html", "docs/*.html", "docs/*", "api/*.htm", "site/*/*.html", "/srv/docs/*.html",
+                        "/srv/*.html", "*/docs/[a-c].html", "missing/*.html"]:
+            path_filter = PathFilter(pattern)
+            directories = {}
+            for doc_id, path in enumerate(paths):
+                directories.setdefault(os.path.dirname(path), []).append((os.path.basename(path), doc_id))
+            documents = path_filter.documents(directories)
+            expected = {doc_id for doc_id, path in enumerate(paths) if Path(path).match(pattern)}
+            assert (documents if documents is not None else set(range(len(paths)))) == expected, pattern
+        
+        assert PathFilter("*").documents({}) is None
+        assert PathFilter("docs/*.html").allows({"../site/docs": []})
+        assert not PathFilter("docs/*.html").allows({"../site": [], "../site/img": []})
+    
+    def test_sharded_search(self):
+        """Тестування пошуку в кількох коренях сайту з паралельним розсиланням запиту"""
+        from concurrent.futures import ThreadPoolExecutor
+        with tempfile.TemporaryDirectory() as temp_dir:
+            roots = [str(Path(temp_dir) / "main"), str(Path(temp_dir) / "blog")]
+            for root in roots:
+                Path(root, "posts").mkdir(parents=True)
+            self._write_site(roots[0])
+            for i in range(3):
+                Path(roots[1], "posts", f"post{i}.html").write_text(
+                    f"<html><head><title>Post {i}</title></head><body><p>Docker {'tips ' * i}</p></body></html>")
+            
+            refreshers = [IndexRefresher(lambda root=root: list_files(root, ["html"]), root, ["html"], use_watcher=False)
+                          for root in roots]
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                view = ShardedRefresher(roots, refreshers, executor).get_index()
+                
+                response = run_search(view, "docker", "*", "#{href}", None, None)
+                assert response["results_count"] == 5
+                assert response["total_matches"] == 5
+                assert {result["href"] for result in response["results"]} == {
+                    *[str(Path(roots[0]) / name) for name in ("index.html", "about.html")],
+                    *[str(Path(roots[1], "posts", f"post{i}.html")) for i in range(3)]
+                }
+                
+                # Сторінки з курсором проходять по всіх шардах без повторів і пропусків
+                pages = []
+                cursor = None
+                while True:
+                    page = run_search(view, "docker", "*", "#{href}", None, None, False, 2, cursor)
+                    assert page["results_count"] == 5
+                    pages.extend(result["href"] for result in page["results"])
+                    cursor = page["next_cursor"]
+                    if cursor is None:
+                        break
+                assert pages == [result["href"] for result in response["results"]]
+                
+                # Фільтр відсікає шард, у якому немає відповідних каталогів
+                with patch.object(view.shards[0], "hits", wraps=view.shards[0].hits) as main_hits:
+                    filtered = run_search(view, "docker", "posts/*.html", "#{title}", None, None)
+                    main_hits.assert_not_called()
+                assert filtered["results_count"] == 3
+                assert run_search(view, "docker", "main/about.html", "#{title}", None, None)["results_count"] == 1
+                
+                assert run_suggest(view, "do", 5)["suggestions"] == [{"text": "docker", "count": 5}]
+                assert view.describe()["documents"] == 5
+                assert len(view.describe()["shards"]) == 2
+    
+    def test_document_cache(self):
+        """Тестування кешу розібраних документів з LRU-витісненням"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._write_site(temp_dir)
+            cache = LRUCache(1024 * 1024, sizeof=lambda document: document.size)
+            refresher = IndexRefresher(lambda: list_files(temp_dir, ["html"]), temp_dir, ["html"],
+                                       use_watcher=False, document_cache=cache)
+            refresher.get_index()
+            assert cache.stats()["misses"] == 2
+            
+            # Повна перебудова незміненого сайту не читає і не розбирає файли
+            with patch("search_index.parse_document") as parse_mock:
+                index = refresher.rebuild()
+                parse_mock.assert_not_called()
+            assert len(index) == 2
+            assert index.generation == 1
+            assert cache.stats()["hits"] == 2
+    
+    def test_lru_cache_eviction(self):
+        """Тестування витіснення за сумарним розміром значень"""
+        cache = LRUCache(10)
+        cache.put("a", "12345")
+        cache.put("b", "12345")
+        assert cache.get("a") == "12345"
+        cache.put("c", "123")
+        
+        # Витісняється найдавніше використаний запис
+        assert cache.get("b") is None
+        assert cache.get("a") == "12345"
+        assert cache.get("c") == "123"
+        assert cache.stats()["evictions"] == 1
+        assert cache.size == 8
+        
+        # Значення, більше за весь кеш, не зберігається
+        cache.put("d", "x" * 11)
+        assert cache.get("d") is None
+    
+    @pytest.mark.asyncio
+    async def test_search_result_cache(self):
+        """Тестування дворівневого кешу результатів пошуку"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            cache_dir = str(Path(temp_dir) / "cache")
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, cache_dir)), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                first = await search("docker", "*", "#{title}", 5, None, False, None, None, None, None, None)
+                # liveCount без liveSearch не впливає на ключ кешу
+                second = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 1
+                assert first.body == second.body
+                assert json.loads(first.body)["results_count"] == 2
+            
+            # Дисковий рівень переживає перезапуск процесу
+            disk_cache = ResultCache(60, 1024 * 1024, cache_dir)
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", disk_cache), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                third = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 0
+                assert third.body == first.body
+                assert disk_cache.disk_hits == 1
+
+            # Новий формат відповіді не отримує відповіді, збережені старим кодом
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, cache_dir)), \
+                 patch("search.RESPONSE_FORMAT", RESPONSE_FORMAT + 1), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 1
+
+            # Зміна корпусу змінює ключ кешу
+            key = ResultCache.make_key(index.fingerprint, "docker")
+            assert disk_cache.get("other-fingerprint", ResultCache.make_key("other-fingerprint", "docker")) is None
+            assert len(disk_cache.memory) == 0
+            
+            # Прострочені записи не повертаються
+            expired_cache = ResultCache(-1, 1024 * 1024)
+            expired_cache.put(index.fingerprint, key, b"{}")
+            assert expired_cache.get(index.fingerprint, key) is None
+    
+    def test_result_cache_disk_is_bounded(self):
+        """Тестування обмеження дискового рівня кешу результатів"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = Path(temp_dir) / "search"
+            cache = ResultCache(60, 1024 * 1024, str(cache_dir), disk_max_size=10 * 1000)
+            
+            # Кожен унікальний запит пише файл, але їхній загальний розмір обмежено
+            for i in range(500):
+                cache.put("first", ResultCache.make_key("first", f"query {i}"), b"x" * 100)
+            files = list(cache_dir.rglob("*.cache"))
+            assert sum(path.stat().st_size for path in files) <= 10 * 1000 + 200
+            assert cache.stats()["disk_evictions"] > 0
+            # Найновіші записи залишаються
+            assert cache.get("first", ResultCache.make_key("first", "query 499")) == b"x" * 100
+            
+            # Зміна відбитка корпусу видаляє файли попереднього
+            cache.put("second", ResultCache.make_key("second", "query"), b"y")
+            assert len(list(cache_dir.iterdir())) == 1
+            assert len(list(cache_dir.rglob("*.cache"))) == 1
+            
+            # Запит, що ще відповідає зі старого відбитка, не видаляє файли нового
+            cache.put("first", ResultCache.make_key("first", "late query"), b"z")
+            assert cache.get("second", ResultCache.make_key("second", "query")) == b"y"
+            assert len(list(cache_dir.iterdir())) == 2
+            
+            # Новий відбиток знову прибирає всі інші
+            cache.put("third", ResultCache.make_key("third", "query"), b"t")
+            assert len(list(cache_dir.iterdir())) == 1
+    
+    @pytest.mark.asyncio
+    async def test_shared_result_cache(self):
+        """Тестування спільного кешу результатів і лічильника поколінь у Redis"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            client = FakeRedis()
+            # Два воркери з власними кешами в пам'яті та спільним Redis
+            first_worker = SharedCache(client)
+            second_worker = SharedCache(client)
+            refresher = MagicMock()
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.shared_cache", first_worker), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, None, first_worker)), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                first = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.shared_cache", second_worker), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, None, second_worker)), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                second = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 0
+                assert second.body == first.body
+                assert second_worker.hits == 1
+            
+            # Переіндексація в одному воркері змушує інший оновити індекс
+            from search import get_index
+            with patch("search.shared_cache", second_worker), \
+                 patch("search.index_refresher", refresher):
+                assert second_worker.poll() is False
+                first_worker.bump()
+                get_index()
+                assert refresher.refresh.call_count == 1
+                get_index()
+                assert refresher.refresh.call_count == 1
+            
+            # Після зміни покоління старі відповіді більше не використовуються
+            with patch("search.get_index", return_value=index), \
+                 patch("search.shared_cache", second_worker), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, None, second_worker)), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 1
+            
+            # Недоступний Redis не ламає пошук: кеш працює лише в пам'яті процесу
+            client.down = True
+            with patch("search.get_index", return_value=index), \
+                 patch("search.shared_cache", second_worker), \
+                 patch("search.result_cache", ResultCache(60, 1024 * 1024, None, second_worker)), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                third = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                fourth = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 1
+                assert third.body == first.body
+                assert fourth.body == first.body
+            assert second_worker.errors == 1
+            assert second_worker.available is False
+            assert second_worker.poll() is False
+            
+            # Без REDIS_URL спільний кеш не створюється
+            assert SharedCache.from_url(None) is None
+    
+    @pytest.mark.asyncio
+    async def test_search_runs_off_event_loop(self):
+        """Тестування виконання пошуку в окремому пулі потоків"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            threads = []
+            
+            def fake_run_search(*args):
+                threads.append(threading.current_thread().name)
+                return run_search(*args)
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch("search.run_search", side_effect=fake_run_search):
+                response = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+            
+            assert json.loads(response.body)["results_count"] == 2
+            assert threads[0].startswith("search")
+            assert threads[0] != threading.current_thread().name
+    
+    @pytest.mark.asyncio
+    async def test_search_coalesces_identical_requests(self):
+        """Тестування об'єднання однакових одночасних запитів пошуку"""
+        import asyncio
+        import time
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            def slow_run_search(*args):
+                time.sleep(0.1)
+                return run_search(*args)
+            
+            flights = SingleFlight()
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch("search.search_flights", flights), \
+                 patch("search.run_search", side_effect=slow_run_search) as run_mock:
+                responses = await asyncio.gather(
+                    search("docker", "*", "#{title}", None, None, False, None, None, None, None, None),
+                    search("docker", "*", "#{title}", 5, None, False, None, None, None, None, None),
+                    search("docker", "*", "#{title}", None, None, False, None, None, None, None, None),
+                    search("fastapi", "*", "#{title}", None, None, False, None, None, None, None, None)
+                )
+                # liveCount без liveSearch не змінює ключ, тому три запити виконуються один раз
+                assert run_mock.call_count == 2
+                assert responses[0].body == responses[1].body == responses[2].body
+                assert flights.stats() == {"requests": 4, "coalesced": 2, "in_flight": 0}
+                
+                # Послідовні запити не об'єднуються
+                await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                assert run_mock.call_count == 3
+        
+        # Виняток отримують усі очікувачі, а скасування одного не зупиняє обчислення
+        calls = []
+        
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+        
+        flights = SingleFlight()
+        first = asyncio.ensure_future(flights.run("key", failing))
+        second = asyncio.ensure_future(flights.run("key", failing))
+        third = asyncio.ensure_future(flights.run("key", failing))
+        await asyncio.sleep(0)
+        first.cancel()
+        results = await asyncio.gather(first, second, third, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert [type(result) for result in results[1:]] == [ValueError, ValueError]
+        assert calls == [1]
+        assert flights.stats()["in_flight"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_search_conditional_get(self):
+        """Тестування ETag і відповіді 304 без виконання пошуку"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = self._write_site(temp_dir)
+            index = build_index(files)
+            # Браузер завжди приймає стиснення
+            accept = "gzip, deflate, br"
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch("search.run_search", wraps=run_search) as run_mock:
+                first = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, accept)
+                etag = first.headers["etag"]
+                # Невелика відповідь не стискається і має сильний ETag
+                assert etag.startswith('"') and etag.endswith('"')
+                assert "content-encoding" not in first.headers
+                assert first.headers["cache-control"] == settings.search_cache_control
+                
+                # Той самий ETag у If-None-Match дає 304 без виконання запиту
+                for if_none_match in (etag, f'"other", W/{etag}', "*"):
+                    response = await search("docker", "*", "#{title}", None, None, False, None, None, None,
+                                            if_none_match, accept)
+                    assert response.status_code == 304
+                    assert response.body == b""
+                    assert response.headers["etag"] == etag
+                assert run_mock.call_count == 1
+                
+                # Нормалізовані параметри мають той самий ETag, інший запит — інший
+                same = await search("docker", "*", "#{title}", 5, None, False, None, None, None, None, accept)
+                other = await search("fastapi", "*", "#{title}", None, None, False, None, None, None, etag, accept)
+                assert same.headers["etag"] == etag
+                assert other.status_code == 200
+                assert other.headers["etag"] != etag
+
+            # Новий формат відповіді змінює ETag
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch("search.RESPONSE_FORMAT", RESPONSE_FORMAT + 1):
+                response = await search("docker", "*", "#{title}", None, None, False, None, None, None, etag, accept)
+                assert response.status_code == 200
+                assert response.headers["etag"] != etag
+            
+            # Нове покоління індексу змінює ETag
+            Path(files[0]).write_text("<html><head><title>Changed</title></head><body>docker</body></html>")
+            changed = index.updated({files[0]: file_stat(files[0])})
+            with patch("search.get_index", return_value=changed), \
+                 patch("search.result_cache", None):
+                response = await search("docker", "*", "#{title}", None, None, False, None, None, None, etag, accept)
+                assert response.status_code == 200
+                assert response.headers["etag"] != etag
+    
+    @pytest.mark.asyncio
+    async def test_search_pagination(self):
+        """Тестування посторінкової видачі з курсором"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(7):
+                (Path(temp_dir) / f"page{i}.html").write_text(f"<body><p>common {'word ' * i}</p></body>")
+            index = build_index(sorted(list_files(temp_dir, ["html"])))
+            
+            pages = []
+            cursor = None
+            while True:
+                response = run_search(index, "common", "*", "#{href}", None, None, False, 3, cursor)
+                pages.append([result["href"] for result in response["results"]])
+                # Загальна кількість не залежить від сторінки
+                assert response["results_count"] == 7
+                cursor = response["next_cursor"]
+                if cursor is None:
+                    break
+            
+            assert [len(page) for page in pages] == [3, 3, 1]
+            hrefs = [href for page in pages for href in page]
+            assert hrefs == [result["href"] for result in run_search(index, "common", "*", "#{href}", None, None)["results"]]
+            
+            with patch("search.get_index", return_value=index), pytest.raises(HTTPException) as error:
+                await search("common", "*", "#{href}", None, None, False, None, 3, "not-a-cursor", None, None)
+            assert error.value.status_code == 400
+    
+    @pytest.mark.asyncio
+    async def test_stream_search(self):
+        """Тестування потокової видачі результатів у форматах NDJSON та SSE"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            with patch("search.get_index", return_value=index):
+                response = await search("docker", "*", "#{title}", None, None, False, "ndjson", None, None, None, None)
+                lines = [json.loads(line) async for line in response.body_iterator]
+                
+                assert response.media_type == "application/x-ndjson"
+                assert [line["type"] for line in lines] == ["result", "result", "summary"]
+                assert lines[0]["formatted"] == "About"
+                assert lines[-1] == {"type": "summary", "query": "docker", "results_count": 2, "total_matches": 2,
+                                     "next_cursor": None}
+                
+                response = await search("docker", "*", "#{title}", 1, "live", False, "sse", None, None, None, None)
+                chunks = [chunk async for chunk in response.body_iterator]
+                
+                assert response.media_type == "text/event-stream"
+                assert chunks[0].startswith(b"event: result\ndata: {")
+                assert chunks[-1].startswith(b'event: summary\ndata: {"query":"docker","results_count":2,"total_matches":2,')
+    
+    def test_template_plan(self):
+        """Тестування компіляції шаблону результату в план відображення"""
+        plan = TemplatePlan("<a href='#{href}'>#{title}</a> #{Title} #{Description}#{count}#{}")
+        
+        assert plan.literals == ["<a href='", "'>", "</a> #{Title} ", "", "", ""]
+        assert plan.meta == ["description", ""]
+        fields = {"title": "Home", "href": "index.html", "token": "...", "count": "2"}
+        assert plan.render(fields, {"description": "Main"}) == "<a href='index.html'>Home</a> #{Title} Main2"
+        
+        # План кешується за рядком шаблону
+        assert compile_template("#{title}") is compile_template("#{title}")
+    
+    def test_search_uses_index(self):
+        """Тестування ендпоінту пошуку поверх індексу"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            response = run_search(index, "fastapi", "*", "#{title}|#{count}|#{description}", None, None)
+            
+            assert response["results_count"] == 1
+            assert response["total_matches"] == 2
+            assert response["results"][0]["formatted"] == "Home|2|Main page"
+            assert '<span class="search">FastAPI</span>' in response["results"][0]["snippet"]
+    
+    def test_search_multiple_terms(self):
+        """Тестування пошуку кількох слів, що не стоять поруч"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(self._write_site(temp_dir))
+            
+            response = run_search(index, "fastapi+images", "*", "#{title}", None, None)
+            
+            assert response["results_count"] == 1
+            # Підсвічуються всі слова запиту
+            assert response["total_matches"] == 3
+            assert '<span class="search">images</span>' in response["results"][0]["snippet"]
+
+
+class TestBenchmark:
+    """Тестування інструмента вимірювання швидкості пошуку"""
+    
+    def test_synthetic_corpus_is_reproducible(self):
+        """Тестування відтворюваності синтетичного корпусу та набору запитів"""
+        import random
+        vocabulary = make_vocabulary(200, random.Random(7))
+        assert vocabulary == make_vocabulary(200, random.Random(7))
+        assert len(set(vocabulary)) == 200
+        
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            first_paths = generate_corpus(first, 8, 50, vocabulary, 7)
+            second_paths = generate_corpus(second, 8, 50, vocabulary, 7)
+            assert len(first_paths) == 8
+            assert Path(first_paths[0]).parent.name == "docs"
+            assert [Path(path).read_text() for path in first_paths] == [Path(path).read_text() for path in second_paths]
+        
+        requests = make_requests(100, vocabulary, 7)
+        assert len(requests) == 100
+        assert requests == make_requests(100, vocabulary, 7)
+        assert {request[0] for request in requests} == {"live", "full", "phrase", "filter", "template"}
+    
+    def test_inprocess_report(self):
+        """Тестування JSON-звіту для запуску в процесі"""
+        import argparse
+        import search
+        refresher = search.index_refresher
+        flights = search.search_flights
+        args = argparse.Namespace(mode="inprocess", pages=20, words=60, vocabulary=100, requests=40, concurrency=4,
+                                  seed=1, cache=False, workers=1, url=None, corpus_dir=None, output=None)
+        # Налаштовані SEARCH_DIRS не підміняють згенерований корпус
+        with patch.object(settings, "search_dirs", ["/nonexistent/site"]):
+            with tempfile.TemporaryDirectory() as corpus, serving(corpus, corpus, False) as serving_search:
+                assert serving_search.search_roots() == [corpus]
+                # Без кешу однакові одночасні запити не об'єднуються
+                assert serving_search.result_cache is None and serving_search.compressed_cache is None
+                assert isinstance(serving_search.search_flights, Uncoalesced)
+            assert settings.search_dirs == ["/nonexistent/site"]
+            result = benchmark(args)
+        
+        assert result["latency"]["requests"] == 40
+        assert sum(kind["requests"] for kind in result["by_kind"].values()) == 40
+        assert result["latency"]["p50_ms"] <= result["latency"]["p95_ms"] <= result["latency"]["p99_ms"]
+        assert result["throughput_rps"] > 0
+        assert result["peak_rss_kb"] > 0
+        assert result["parameters"]["pages"] == 20
+        json.dumps(result)
+        # Після вимірювання модуль пошуку знову працює з сайтом
+        assert search.index_refresher is refresher
+        assert search.search_flights is flights
+
+
+class TestCompression:
+    """Тестування попередньо стиснених статичних файлів і стиснення відповідей"""
+    
+    def test_choose_encoding(self):
+        """Тестування вибору кодування за заголовком Accept-Encoding"""
+        assert choose_encoding("gzip, deflate, br", ["br", "gzip"]) == "br"
+        assert choose_encoding("gzip;q=1.0, br;q=0.5", ["br", "gzip"]) == "gzip"
+        assert choose_encoding("br;q=0, *", ["br", "gzip"]) == "gzip"
+        assert choose_encoding("identity", ["br", "gzip"]) is None
+        assert choose_encoding(None, ["gzip"]) is None
+    
+    def test_precompressed_static_files(self):
+        """Тестування запису стиснених копій і їх видачі з урахуванням Accept-Encoding"""
+        import gzip
+        import time
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        with tempfile.TemporaryDirectory() as temp_dir:
+            css = Path(temp_dir) / "css" / "style.css"
+            css.parent.mkdir()
+            css.write_text(".search { color: red; }\n" * 200)
+            (Path(temp_dir) / "small.css").write_text("a{}")
+            (Path(temp_dir) / "logo.png").write_bytes(b"\x89PNG" * 1000)
+            
+            assert precompress(temp_dir, 1024) == {"files": 2, "written": len(ENCODINGS)}
+            assert gzip.decompress(Path(str(css) + ".gz").read_bytes()) == css.read_bytes()
+            assert not (Path(temp_dir) / "small.css.gz").exists()
+            assert not (Path(temp_dir) / "logo.png.gz").exists()
+            # Повторний запуск не перестискає незмінені файли
+            assert precompress(temp_dir, 1024)["written"] == 0
+            
+            app = FastAPI()
+            app.mount("/", PrecompressedStaticFiles(directory=temp_dir), name="static")
+            client = TestClient(app)
+            
+            response = client.get("/css/style.css", headers={"Accept-Encoding": "gzip"})
+            assert response.headers["content-encoding"] == "gzip"
+            assert response.headers["vary"] == "Accept-Encoding"
+            assert response.headers["content-type"].startswith("text/css")
+            assert response.content == css.read_bytes()
+            
+            plain = client.get("/css/style.css", headers={"Accept-Encoding": "identity"})
+            assert "content-encoding" not in plain.headers
+            assert plain.headers["vary"] == "Accept-Encoding"
+            assert plain.headers["etag"] != response.headers["etag"]
+            
+            cached = client.get("/css/style.css", headers={"Accept-Encoding": "gzip",
+                                                           "If-None-Match": response.headers["etag"]})
+            assert cached.status_code == 304
+            
+            # Застаріла стиснена копія не видається
+            time.sleep(0.01)
+            css.write_text(".search { color: blue; }\n" * 200)
+            stale = client.get("/css/style.css", headers={"Accept-Encoding": "gzip"})
+            assert "content-encoding" not in stale.headers
+            assert "blue" in stale.text
+    
+    @pytest.mark.asyncio
+    async def test_search_response_compression(self):
+        """Тестування стиснення великих відповідей пошуку на льоту"""
+        import gzip
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index = build_index(TestSearchIndex()._write_site(temp_dir))
+            
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch("search.compressed_cache", LRUCache(1024 * 1024)), \
+                 patch.object(settings, "compress_min_size", 100):
+                plain = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, None)
+                compressed = await search("docker", "*", "#{title}", None, None, False, None, None, None, None,
+                                          "gzip")
+                assert "content-encoding" not in plain.headers
+                assert compressed.headers["content-encoding"] == "gzip"
+                assert compressed.headers["vary"] == "Accept-Encoding"
+                assert gzip.decompress(compressed.body) == plain.body
+                
+                # Стиснена відповідь має власний сильний ETag, який теж дає 304
+                assert compressed.headers["etag"] == plain.headers["etag"][:-1] + '-gzip"'
+                response = await search("docker", "*", "#{title}", None, None, False, None, None, None,
+                                        compressed.headers["etag"], "gzip")
+                assert response.status_code == 304
+                assert response.headers["etag"] == compressed.headers["etag"]
+            
+            # Малі відповіді не стискаються
+            with patch("search.get_index", return_value=index), \
+                 patch("search.result_cache", None), \
+                 patch.object(settings, "compress_min_size", 1024 * 1024):
+                response = await search("docker", "*", "#{title}", None, None, False, None, None, None, None, "gzip")
+                assert "content-encoding" not in response.headers
+
+
 class TestRecaptchaFunctions:
     """Тестування функцій reCAPTCHA"""
     